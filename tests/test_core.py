@@ -28,7 +28,10 @@
 import unittest
 import os
 import json
+import shutil
 import sys
+import tempfile
+import time
 sys.path.append(os.path.join(os.path.dirname(__file__), '../'))
 import user_deprovision  # NOQA
 
@@ -40,6 +43,11 @@ input_filename = os.path.join(
     os.path.dirname(__file__),
     './input/core.json'
 )
+# Deprovision recorded with --record against a small account
+replay_filename = os.path.join(
+    os.path.dirname(__file__),
+    './input/replay.jsonl'
+)
 config_filname = os.path.join(os.path.dirname(__file__), './config.json')
 
 with open(expected_filename) as expected_file:
@@ -152,6 +160,345 @@ class CoreLogicTests(unittest.TestCase):
         )
         self.assertEqual(expected_result, actual_result)
 
+    def get_blocking_services(self):
+        for i, case in enumerate(input['get_blocking_services']):
+            expected_result = expected['get_blocking_services'][i]
+            service_index = user_deprovision.ServiceIndex(case['services'])
+            actual_result = service_index.get_blocking_services(
+                case['escalation_policy_id']
+            )
+            self.assertEqual(expected_result, actual_result)
+            self.assertEqual(
+                not expected_result,
+                service_index.can_delete_escalation_policy(
+                    case['escalation_policy_id']
+                )
+            )
+
+    def iter_open_incidents(self):
+        case = input['iter_open_incidents'][0]
+        expected_result = expected['iter_open_incidents'][0]
+        delete_user = user_deprovision.DeleteUser(config['access_token'])
+        open_ids = ['P{i:04d}'.format(i=i) for i in range(case['total'])]
+        offsets = []
+
+        # Resolved incidents drop out of the listing as the API would
+        def get_page(endpoint, payload):
+            offsets.append(payload['offset'])
+            page = open_ids[payload['offset']:][:payload['limit']]
+            return {
+                'incidents': [{'id': x} for x in page],
+                'more': payload['offset'] + len(page) < len(open_ids)
+            }
+
+        def put(endpoint, payload, from_email):
+            incident_id = endpoint.split('/')[-1]
+            if incident_id in case['unresolvable']:
+                raise Exception(incident_id)
+            open_ids.remove(incident_id)
+        delete_user.pd_rest.get_page = get_page
+        delete_user.pd_rest.put = put
+        delete_user.resolve_incidents(
+            (x['id'] for x in delete_user.iter_open_incidents('ABCDEF')),
+            'user@example.com'
+        )
+        self.assertEqual(expected_result['offsets'], offsets)
+        self.assertEqual(expected_result['open'], open_ids)
+
+    def get_user_ids(self):
+        expected_result = expected['get_user_ids'][0]
+        directory = user_deprovision.UserDirectory(
+            input['get_user_ids'][0]['users']
+        )
+        actual_result = directory.get_user_ids(
+            input['get_user_ids'][0]['emails']
+        )
+        self.assertEqual(expected_result, actual_result)
+        with self.assertRaises(ValueError):
+            directory.get_user_id('ned.stark@winterfell.com')
+
+    def apply_event(self):
+        case = input['apply_event'][0]
+        expected_result = expected['apply_event'][0]
+        delete_user = user_deprovision.DeleteUser(config['access_token'])
+        membership_index = user_deprovision.MembershipIndex()
+        for schedule in case['schedules']:
+            membership_index.add_schedule(schedule)
+        for escalation_policy in case['escalation_policies']:
+            membership_index.add_escalation_policy(escalation_policy)
+        for team in case['teams']:
+            membership_index.add_team(team['team'], team['users'])
+        delete_user.membership_index = membership_index
+        updater = user_deprovision.MembershipIndexUpdater(delete_user)
+        applied = [updater.apply_event(event) for event in case['events']]
+        self.assertEqual(expected_result['applied'], applied)
+        self.assertEqual(
+            expected_result['schedules'],
+            [x['id'] for x in
+             membership_index.get_schedules_for_user(case['user_id'])]
+        )
+        self.assertEqual(
+            expected_result['escalation_policies'],
+            [x['id'] for x in
+             membership_index.get_escalation_policies_for_user(
+                 case['user_id']
+             )]
+        )
+        self.assertEqual(
+            expected_result['teams'],
+            [x['id'] for x in
+             membership_index.get_teams_for_user(case['user_id'])]
+        )
+
+    def account_snapshot(self):
+        case = input['account_snapshot'][0]
+        expected_result = expected['account_snapshot'][0]
+        snapshot = user_deprovision.AccountSnapshot(':memory:')
+        for user in case['users']:
+            snapshot.insert_user(user)
+        for schedule in case['schedules']:
+            snapshot.add_schedule(schedule)
+        for escalation_policy in case['escalation_policies']:
+            snapshot.add_escalation_policy(escalation_policy)
+        for team in case['teams']:
+            snapshot.add_team(team['team'], team['users'])
+        snapshot.add_services(case['services'])
+        self.assertEqual(
+            expected_result['user_id'],
+            snapshot.get_user_id(case['email'])
+        )
+        self.assertEqual(
+            expected_result['schedules'],
+            [x['id'] for x in snapshot.get_schedules_for_user(case['user_id'])]
+        )
+        self.assertEqual(
+            expected_result['user_escalation_policies'],
+            [x['id'] for x in
+             snapshot.get_escalation_policies_for_user(case['user_id'])]
+        )
+        self.assertEqual(
+            expected_result['schedule_escalation_policies'],
+            [x['id'] for x in
+             snapshot.get_escalation_policies_for_schedule('SCHED1')]
+        )
+        self.assertEqual(
+            expected_result['teams'],
+            snapshot.get_teams_for_user(case['user_id'])
+        )
+        self.assertEqual(
+            expected_result['blocking_services'],
+            snapshot.get_blocking_services('EP0001')
+        )
+
+    def get_hedge_delay(self):
+        for i, case in enumerate(input['get_hedge_delay']):
+            expected_result = expected['get_hedge_delay'][i]
+            pd_rest = user_deprovision.PagerDutyREST(config['access_token'])
+            pd_rest.latencies.extend(case['latencies'])
+            actual_result = pd_rest.get_hedge_delay()
+            self.assertEqual(expected_result, actual_result)
+
+    def remap_ids(self):
+        expected_result = expected['remap_ids'][0]
+        actual_result = user_deprovision.remap_ids(
+            input['remap_ids'][0]['object'],
+            input['remap_ids'][0]['ids']
+        )
+        self.assertEqual(expected_result, actual_result)
+
+    def strip_rendered_schedule(self):
+        expected_result = expected['strip_rendered_schedule'][0]
+        actual_result = core.strip_rendered_schedule(
+            input['strip_rendered_schedule'][0]
+        )
+        self.assertEqual(expected_result, actual_result)
+
+    def update_schedule(self):
+        schedule = input['update_schedule'][0]
+        expected_result = expected['update_schedule'][0]
+        delete_user = user_deprovision.DeleteUser(config['access_token'])
+        actual_result = []
+        delete_user.pd_rest.put = lambda endpoint, payload: (
+            actual_result.append([endpoint, payload])
+        )
+        delete_user.update_schedule(schedule['id'], schedule)
+        self.assertEqual(expected_result, actual_result)
+
+    def render_progress(self):
+        for i, event in enumerate(input['render_progress']):
+            expected_result = expected['render_progress'][i]
+            actual_result = user_deprovision.render_progress(event)
+            self.assertEqual(expected_result, actual_result)
+
+    def work_queue(self):
+        expected_result = expected['work_queue']
+        work_queue = user_deprovision.WorkQueue()
+        for priority, kind, item in input['work_queue']:
+            work_queue.put(priority, kind, item)
+        actual_result = [list(x) for x in work_queue.drain()]
+        self.assertEqual(expected_result, actual_result)
+
+    def get_escalation_policy_priority(self):
+        for i, ep in enumerate(input['get_escalation_policy_priority']):
+            expected_result = expected['get_escalation_policy_priority'][i]
+            actual_result = core.get_escalation_policy_priority('ABCDEF', ep)
+            self.assertEqual(expected_result, actual_result)
+
+    def parse_timestamp(self):
+        for i, timestamp in enumerate(input['parse_timestamp']):
+            expected_result = expected['parse_timestamp'][i]
+            actual_result = user_deprovision.parse_timestamp(timestamp)
+            self.assertEqual(expected_result, actual_result)
+
+    def parse_deadline(self):
+        for i, (value, now) in enumerate(input['parse_deadline']):
+            expected_result = expected['parse_deadline'][i]
+            actual_result = user_deprovision.parse_deadline(value, now)
+            self.assertEqual(expected_result, actual_result)
+        deadline = user_deprovision.Deadline(time.time() + 60)
+        self.assertTrue(deadline.allows(30))
+        self.assertFalse(deadline.allows(90))
+
+    def build_cleanup_plan(self):
+        account = input['build_cleanup_plan'][0]
+        expected_result = expected['build_cleanup_plan'][0]
+        actual_result = user_deprovision.build_cleanup_plan(
+            account['schedules'],
+            account['escalation_policies'],
+            account['teams'],
+            account['team_members'],
+            account['services'],
+            account['now']
+        )
+        self.assertEqual(expected_result, actual_result)
+
+    def get_request_key(self):
+        for i, request in enumerate(input['get_request_key']):
+            expected_result = expected['get_request_key'][i]
+            actual_result = user_deprovision.get_request_key(*request)
+            self.assertEqual(expected_result, actual_result)
+
+    def replay_main(self, cassette, deadline=None):
+        rollback_dir = tempfile.mkdtemp()
+        user_deprovision.PagerDutyREST.cassette = cassette
+        try:
+            return user_deprovision.main(
+                'replay',
+                'jane.doe@example.com',
+                'admin@example.com',
+                print_report=False,
+                ask=lambda message: True,
+                workers=1,
+                rollback_bundle=user_deprovision.RollbackBundle(
+                    os.path.join(rollback_dir, 'replay.jsonl.gz')
+                ),
+                deadline=deadline
+            )
+        finally:
+            user_deprovision.PagerDutyREST.cassette = None
+            shutil.rmtree(rollback_dir)
+
+    def replay(self):
+        expected_result = expected['replay'][0]
+        cassette = user_deprovision.Cassette(replay_filename, 'replay', 0)
+        report = self.replay_main(cassette)
+        actual_result = dict((x, report[x]) for x in expected_result)
+        self.assertEqual(expected_result, actual_result)
+        self.assertEqual(0, cassette.count_unplayed())
+
+    def replay_deadline(self):
+        # Stopped before the routing change to the escalation policy
+        expected_result = expected['replay_deadline'][0]
+        report = self.replay_main(
+            user_deprovision.Cassette(replay_filename, 'replay', 0),
+            user_deprovision.Deadline(time.time() - 1)
+        )
+        # Which other objects were checked before the stop varies
+        actual_result = dict((x, report[x]) for x in expected_result)
+        actual_result['checkpoint'] = dict(
+            (x, report['checkpoint'][x])
+            for x in expected_result['checkpoint']
+        )
+        self.assertEqual(expected_result, actual_result)
+
+    def pipeline(self):
+        expected_result = expected['pipeline'][0]
+        actual_result = []
+        user_deprovision.Pipeline(maxsize=2).add_stage(
+            lambda x: x * 2, workers=3
+        ).add_stage(
+            lambda x: x if x % 4 == 0 else None
+        ).add_stage(actual_result.append).run(iter(input['pipeline'][0]))
+        self.assertEqual(expected_result, sorted(actual_result))
+        # Slower earlier items still come out first when ordered
+        actual_result = []
+        user_deprovision.Pipeline(maxsize=2, ordered=True).add_stage(
+            lambda x: time.sleep(0.01 * (3 - x % 3)) or x * 2, workers=3
+        ).add_stage(
+            lambda x: x if x % 4 == 0 else None
+        ).add_stage(actual_result.append).run(iter(input['pipeline'][0]))
+        self.assertEqual(expected_result, actual_result)
+
+        def fail(x):
+            raise ValueError(x)
+        self.assertRaises(
+            ValueError,
+            user_deprovision.Pipeline(maxsize=2).add_stage(fail, workers=2).run,
+            iter(input['pipeline'][0])
+        )
+
+    def membership_matrix(self):
+        account = input['membership_matrix'][0]
+        expected_result = expected['membership_matrix'][0]
+        matrix = user_deprovision.MembershipMatrix()
+        for schedule in account['schedules']:
+            matrix.add_schedule(schedule)
+        for escalation_policy in account['escalation_policies']:
+            matrix.add_escalation_policy(escalation_policy)
+        for team in account['teams']:
+            matrix.add_team(team['id'], team['users'])
+        actual_result = matrix.find(account['user_ids'])
+        self.assertEqual(expected_result, actual_result)
+        matrix.remove('schedule', 'S1')
+        self.assertEqual({}, matrix.find(['U1'], ['schedule']))
+
+    def json_codec(self):
+        codec = user_deprovision.JSONCodec('json')
+        payload = input['json_codec'][0]
+        expected_result = json.loads(expected['json_codec'][0])
+        actual_result = json.loads(codec.dumps(payload))
+        self.assertEqual(expected_result, actual_result)
+        self.assertNotIn(' ', codec.dumps(payload))
+        self.assertEqual(payload, codec.loads(codec.dumps(payload)))
+        # The fastest installed library decodes the same payload
+        self.assertEqual(
+            payload,
+            user_deprovision.JSONCodec().loads(codec.dumps(payload))
+        )
+
+    def apply_audit_records(self):
+        case = input['apply_audit_records'][0]
+        expected_result = expected['apply_audit_records'][0]
+        snapshot = user_deprovision.AccountSnapshot(':memory:')
+        for schedule in case['schedules']:
+            snapshot.add_schedule(schedule)
+        for escalation_policy in case['escalation_policies']:
+            snapshot.add_escalation_policy(escalation_policy)
+        # Deleted objects are removed without fetching anything
+        self.assertEqual(
+            expected_result['changes'],
+            snapshot.apply_audit_records(None, case['records'])
+        )
+        self.assertEqual(
+            expected_result['schedules'],
+            [x['id'] for x in snapshot.get_schedules_for_user('ABCDEF')]
+        )
+        self.assertEqual(
+            expected_result['user_escalation_policies'],
+            [x['id'] for x in
+             snapshot.get_escalation_policies_for_user('ABCDEF')]
+        )
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -164,4 +511,26 @@ def suite():
     suite.addTest(CoreLogicTests('cache_schedule'))
     suite.addTest(CoreLogicTests('cache_team'))
     suite.addTest(CoreLogicTests('cache_escalation_policy'))
+    suite.addTest(CoreLogicTests('get_blocking_services'))
+    suite.addTest(CoreLogicTests('iter_open_incidents'))
+    suite.addTest(CoreLogicTests('get_user_ids'))
+    suite.addTest(CoreLogicTests('apply_event'))
+    suite.addTest(CoreLogicTests('account_snapshot'))
+    suite.addTest(CoreLogicTests('get_hedge_delay'))
+    suite.addTest(CoreLogicTests('remap_ids'))
+    suite.addTest(CoreLogicTests('strip_rendered_schedule'))
+    suite.addTest(CoreLogicTests('update_schedule'))
+    suite.addTest(CoreLogicTests('render_progress'))
+    suite.addTest(CoreLogicTests('work_queue'))
+    suite.addTest(CoreLogicTests('get_escalation_policy_priority'))
+    suite.addTest(CoreLogicTests('parse_timestamp'))
+    suite.addTest(CoreLogicTests('parse_deadline'))
+    suite.addTest(CoreLogicTests('build_cleanup_plan'))
+    suite.addTest(CoreLogicTests('get_request_key'))
+    suite.addTest(CoreLogicTests('replay'))
+    suite.addTest(CoreLogicTests('replay_deadline'))
+    suite.addTest(CoreLogicTests('pipeline'))
+    suite.addTest(CoreLogicTests('membership_matrix'))
+    suite.addTest(CoreLogicTests('json_codec'))
+    suite.addTest(CoreLogicTests('apply_audit_records'))
     return suite
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of PagerDuty Inc nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL PAGERDUTY INC BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import json
+import os
+import sys
+import timeit
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+import user_deprovision  # NOQA
+
+
+def make_escalation_policies(count):
+    """Build a page of escalation policies shaped like the API's"""
+
+    return {
+        'escalation_policies': [{
+            'id': 'P{i:06d}'.format(i=i),
+            'type': 'escalation_policy',
+            'name': 'Escalation policy {i}'.format(i=i),
+            'summary': 'Escalation policy {i}'.format(i=i),
+            'description': None,
+            'num_loops': 0,
+            'teams': [{'id': 'PT{i:05d}'.format(i=i), 'type': 'team_reference'}],
+            'escalation_rules': [{
+                'id': 'PR{i:05d}{j}'.format(i=i, j=j),
+                'escalation_delay_in_minutes': 30,
+                'targets': [{
+                    'id': 'PU{i:05d}{k}'.format(i=i, k=k),
+                    'type': 'user_reference',
+                    'summary': u'User {k} \xe9'.format(k=k)
+                } for k in range(3)]
+            } for j in range(3)]
+        } for i in range(count)],
+        'limit': count,
+        'offset': 0,
+        'more': False,
+        'total': None
+    }
+
+def make_schedule(layers, users):
+    """Build a schedule shaped like the API's, without rendered entries"""
+
+    return {'schedule': {
+        'id': 'PSCHED1',
+        'type': 'schedule',
+        'name': 'Primary',
+        'time_zone': 'America/Los_Angeles',
+        'schedule_layers': [{
+            'id': 'PL{i:05d}'.format(i=i),
+            'name': 'Layer {i}'.format(i=i),
+            'start': '2016-01-01T00:00:00-08:00',
+            'end': None,
+            'rotation_virtual_start': '2016-01-01T00:00:00-08:00',
+            'rotation_turn_length_seconds': 86400,
+            'restrictions': [],
+            'users': [{'user': {
+                'id': 'PU{j:05d}'.format(j=j),
+                'type': 'user_reference',
+                'summary': 'User {j}'.format(j=j)
+            }} for j in range(users)]
+        } for i in range(layers)]
+    }}
+
+def main(number=200):
+    """Times decoding and encoding API payloads with each installed JSON
+    library against the standard library path used before
+    """
+
+    payloads = {
+        'escalation_policies': make_escalation_policies(100),
+        'schedule': make_schedule(20, 50)
+    }
+    results = []
+    for name, payload in sorted(payloads.items()):
+        text = json.dumps(payload)
+        results.append({
+            'payload': name,
+            'backend': 'stdlib (before)',
+            'bytes': len(text),
+            'decode_ms': timeit.timeit(
+                lambda: json.loads(text), number=number) * 1000 / number,
+            'encode_ms': timeit.timeit(
+                lambda: json.dumps(payload), number=number) * 1000 / number
+        })
+        for backend in user_deprovision.JSONCodec.backends:
+            try:
+                codec = user_deprovision.JSONCodec(backend)
+            except ImportError:
+                continue
+            results.append({
+                'payload': name,
+                'backend': backend,
+                'bytes': len(codec.dumps(payload)),
+                'decode_ms': timeit.timeit(
+                    lambda: codec.loads(text), number=number) * 1000 / number,
+                'encode_ms': timeit.timeit(
+                    lambda: codec.dumps(payload), number=number) * 1000 / number
+            })
+    print '{:<20} {:<16} {:>8} {:>10} {:>10}'.format(
+        'payload', 'backend', 'bytes', 'decode ms', 'encode ms'
+    )
+    for x in results:
+        print '{payload:<20} {backend:<16} {bytes:>8} {decode_ms:>10.3f} '\
+            '{encode_ms:>10.3f}'.format(**x)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the JSON libraries used for API payloads'
+    )
+    parser.add_argument(
+        '--number',
+        help='Times to decode and encode each payload',
+        type=int, default=200
+    )
+    args = parser.parse_args()
+    main(args.number)
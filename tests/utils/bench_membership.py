@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of PagerDuty Inc nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL PAGERDUTY INC BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+import user_deprovision  # NOQA
+
+
+def make_account(schedules, escalation_policies, teams, users):
+    """Build full schedules, escalation policies and team members shaped
+    like the API's, with members picked at random from a pool of users
+    """
+
+    random.seed(0)
+    user_ids = ['PU{i:05d}'.format(i=i) for i in range(users)]
+    account = {'schedules': [], 'escalation_policies': [], 'teams': []}
+    for i in range(schedules):
+        layers = [{
+            'id': 'PL{i:05d}{j}'.format(i=i, j=j),
+            'users': [
+                {'user': {'id': x, 'type': 'user_reference'}}
+                for x in random.sample(user_ids, min(6, len(user_ids)))
+            ]
+        } for j in range(3)]
+        account['schedules'].append({
+            'id': 'PS{i:05d}'.format(i=i),
+            'schedule_layers': layers,
+            'users': [
+                {'id': x} for x in
+                set(y['user']['id'] for layer in layers for y in layer['users'])
+            ]
+        })
+    for i in range(escalation_policies):
+        account['escalation_policies'].append({
+            'id': 'PE{i:05d}'.format(i=i),
+            'escalation_rules': [{
+                'targets': [
+                    {'id': x, 'type': 'user_reference'}
+                    for x in random.sample(user_ids, min(2, len(user_ids)))
+                ] + [{
+                    'id': 'PS{i:05d}'.format(i=random.randrange(schedules)),
+                    'type': 'schedule_reference'
+                }]
+            } for j in range(3)]
+        })
+    for i in range(teams):
+        account['teams'].append({
+            'id': 'PT{i:05d}'.format(i=i),
+            'users': [
+                {'id': x}
+                for x in random.sample(user_ids, min(15, len(user_ids)))
+            ]
+        })
+    return account, user_ids
+
+def find_with_helpers(delete_user, account, user_ids):
+    """Find the objects each user is on one user at a time, as main does"""
+
+    found = {}
+    for user_id in user_ids:
+        for schedule in account['schedules']:
+            if delete_user.check_schedule_for_user(user_id, schedule):
+                for layer in schedule['schedule_layers']:
+                    delete_user.get_user_layer_index(user_id, layer)
+                found[user_id] = found.get(user_id, 0) + 1
+        for ep in account['escalation_policies']:
+            if delete_user.get_target_indices(user_id, ep['escalation_rules']):
+                found[user_id] = found.get(user_id, 0) + 1
+        for team in account['teams']:
+            if delete_user.check_team_for_user(user_id, team['users']):
+                found[user_id] = found.get(user_id, 0) + 1
+    return found
+
+def build_matrix(account):
+    """Intern the account's IDs into a membership matrix"""
+
+    matrix = user_deprovision.MembershipMatrix()
+    for schedule in account['schedules']:
+        matrix.add_schedule(schedule)
+    for ep in account['escalation_policies']:
+        matrix.add_escalation_policy(ep)
+    for team in account['teams']:
+        matrix.add_team(team['id'], [x['id'] for x in team['users']])
+    return matrix
+
+def main(schedules=2000, escalation_policies=2000, teams=500, users=5000,
+         batches=(1, 10, 100, 1000)):
+    """Times finding the objects a batch of users is on with the per-user
+    helpers against a bitset membership matrix
+    """
+
+    account, user_ids = make_account(
+        schedules,
+        escalation_policies,
+        teams,
+        users
+    )
+    delete_user = user_deprovision.DeleteUser('benchmark')
+    started = time.time()
+    matrix = build_matrix(account)
+    print 'Matrix of {rows} objects and {ids} IDs built in {ms:.1f} ms'\
+        .format(
+            rows=len(matrix.rows),
+            ids=len(matrix.interner.ids),
+            ms=(time.time() - started) * 1000
+        )
+    print '{:>6} {:>14} {:>12} {:>9}'.format(
+        'users', 'helpers ms', 'matrix ms', 'speedup'
+    )
+    # Batches larger than the account are cut down to every user, once
+    batches = sorted(set(min(x, len(user_ids)) for x in batches))
+    for batch in batches:
+        batch_user_ids = random.sample(user_ids, batch)
+        started = time.time()
+        expected = find_with_helpers(delete_user, account, batch_user_ids)
+        helpers_ms = (time.time() - started) * 1000
+        started = time.time()
+        found = matrix.find(batch_user_ids)
+        matrix_ms = (time.time() - started) * 1000
+        # Both ways have to find the same number of objects for every user
+        assert expected == dict((x, len(y)) for x, y in found.items())
+        print '{batch:>6} {helpers:>14.1f} {matrix:>12.1f} {speedup:>8.0f}x'\
+            .format(
+                batch=batch,
+                helpers=helpers_ms,
+                matrix=matrix_ms,
+                speedup=helpers_ms / matrix_ms
+            )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark finding which users are on which objects'
+    )
+    parser.add_argument(
+        '--schedules',
+        help='Schedules in the generated account',
+        type=int, default=2000
+    )
+    parser.add_argument(
+        '--escalation-policies',
+        help='Escalation policies in the generated account',
+        dest='escalation_policies', type=int, default=2000
+    )
+    parser.add_argument(
+        '--teams',
+        help='Teams in the generated account',
+        type=int, default=500
+    )
+    parser.add_argument(
+        '--users',
+        help='Users in the generated account',
+        type=int, default=5000
+    )
+    args = parser.parse_args()
+    main(args.schedules, args.escalation_policies, args.teams, args.users)
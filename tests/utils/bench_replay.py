@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of PagerDuty Inc nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL PAGERDUTY INC BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import json
+import os
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../../'))
+import user_deprovision  # NOQA
+
+
+def main(cassette_filename, user_email, from_email, runs=1,
+        latency_scale=1.0):
+    """Replays a deprovision recorded with user_deprovision.py --record
+    several times and reports how long each run took. A run fails if it
+    makes a request that was not recorded or leaves recorded ones unplayed.
+    from_email is sent when the recorded run resolved incidents.
+    """
+
+    timings = []
+    for i in xrange(runs):
+        cassette = user_deprovision.Cassette(
+            cassette_filename,
+            'replay',
+            latency_scale
+        )
+        user_deprovision.PagerDutyREST.cassette = cassette
+        started = time.time()
+        report = user_deprovision.main('replay', user_email, from_email,
+            print_report=False, ask=lambda message: True)
+        timings.append(time.time() - started)
+        if cassette.count_unplayed():
+            raise Exception('Run {run} left {count} recorded responses '
+                'unplayed'.format(run=i + 1, count=cassette.count_unplayed()))
+    print json.dumps({
+        'runs': runs,
+        'latency_scale': latency_scale,
+        'min': min(timings),
+        'mean': sum(timings) / len(timings),
+        'max': max(timings),
+        'unpageable_after': report['unpageable_after']
+    }, indent=2)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark a recorded deprovision by replaying it offline'
+    )
+    parser.add_argument('cassette_filename', help='Cassette from --record')
+    parser.add_argument('user_email', help='Email of the recorded user')
+    parser.add_argument(
+        '--from-email',
+        help='Email of the requesting agent, used to resolve the recorded '
+        'incidents',
+        default='replay@example.com'
+    )
+    parser.add_argument(
+        '--runs',
+        help='Number of times to replay the run',
+        type=int, default=1
+    )
+    parser.add_argument(
+        '--latency-scale',
+        help='Multiply the recorded latencies by this, 0 to not wait',
+        type=float, default=1.0
+    )
+    args = parser.parse_args()
+    main(args.cassette_filename, args.user_email, args.from_email, args.runs,
+        args.latency_scale)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2016, PagerDuty, Inc. <info@pagerduty.com>
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of PagerDuty Inc nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL PAGERDUTY INC BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import argparse
+import hashlib
+import hmac
+import json
+import time
+import requests
+
+
+def sign(body, secret):
+    """Sign a webhook body the way PagerDuty v3 webhooks are signed"""
+
+    return 'v1=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def main(events_filename, url, secret=None, delay=0):
+    """Replays the change events in a JSON lines file against a local webhook
+    receiver, e.g. the one started by user_deprovision.py --webhook-port
+    """
+
+    with open(events_filename) as events_file:
+        for line in events_file:
+            if not line.strip():
+                continue
+            body = json.dumps({'event': json.loads(line)})
+            headers = {'Content-Type': 'application/json'}
+            if secret:
+                headers['X-PagerDuty-Signature'] = sign(body, secret)
+            r = requests.post(url, data=body, headers=headers)
+            print '{code}: {body}'.format(code=r.status_code, body=r.text)
+            time.sleep(delay)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Replay change events against a local webhook receiver'
+    )
+    parser.add_argument('events_filename', help='JSON lines file of events')
+    parser.add_argument(
+        '--url',
+        help='URL of the webhook receiver',
+        default='http://127.0.0.1:8081/'
+    )
+    parser.add_argument('--secret', help='Secret used to sign the webhooks')
+    parser.add_argument(
+        '--delay',
+        help='Seconds to wait between events',
+        type=float, default=0
+    )
+    args = parser.parse_args()
+    main(args.events_filename, args.url, args.secret, args.delay)
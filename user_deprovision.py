@@ -26,78 +26,290 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import BaseHTTPServer
+import calendar
+import collections
+import copy
 from datetime import datetime
+import gzip
+import hashlib
+import heapq
+import hmac
 import json
 import logging
+import math
 import os
+import Queue
 import requests
+import SocketServer
+import sqlite3
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import uuid
+
+class JSONCodec():
+    """Encode and decode API payloads with the fastest JSON library that is
+    installed, falling back to the standard library
+    """
+
+    # Libraries to try, fastest first
+    backends = ('ujson', 'simplejson', 'json')
+
+    def __init__(self, backend=None):
+        for name in [backend] if backend else self.backends:
+            try:
+                self.backend = __import__(name)
+            except ImportError:
+                if backend:
+                    raise
+                continue
+            break
+        self.name = self.backend.__name__
+
+    def dumps(self, obj):
+        """Encode without any whitespace between tokens"""
+
+        # ujson never adds whitespace and takes no separators
+        if self.name == 'ujson':
+            return self.backend.dumps(obj)
+        return self.backend.dumps(obj, separators=(',', ':'))
+
+    def loads(self, data):
+        """Decode a response body"""
+
+        return self.backend.loads(data)
 
 class PagerDutyREST():
     """Class to handle all calls to the PagerDuty API"""
 
-    def __init__(self, access_token):
+    # (connect, read) timeouts in seconds for every request
+    timeout = (3.05, 30)
+    # Send a duplicate of GETs slower than the observed p95 latency...
+    hedge = False
+    # ...but never hedge more than this fraction of GETs
+    max_hedge_ratio = 0.05
+    # Latencies to observe before hedging starts
+    hedge_min_samples = 20
+    # Cassette that requests are recorded to or replayed from
+    cassette = None
+    # Encodes request bodies and decodes responses
+    codec = JSONCodec()
+
+    def __init__(self, access_token, requests_per_second=None):
         self.base_url = 'https://api.pagerduty.com'
+        self.access_token = access_token
         self.headers = {
             'Accept': 'application/vnd.pagerduty+json;version=2',
             'Authorization': 'Token token={token}'.format(token=access_token)
         }
+        # Reuse connections across requests
+        self.session = requests.Session()
+        # Spread requests out to stay within this account's rate limit
+        self.requests_per_second = requests_per_second
+        self.next_request_at = 0
+        self.throttle_lock = threading.Lock()
+        self.max_rate_limit_retries = 5
+        # Recent GET latencies and counts used to decide when to hedge
+        self.latencies = collections.deque(maxlen=200)
+        self.get_count = 0
+        self.hedge_count = 0
+        self.hedge_lock = threading.Lock()
+        # Requests currently waiting on the API, reported as progress
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+        # ProgressReporter told about pages fetched by paginated GETs
+        self.progress = None
 
-    def get(self, endpoint, payload={}, resource=None):
-        """Handle all GET requests"""
+    def get_hedge_delay(self):
+        """Get the p95 GET latency, or None until enough GETs were seen"""
+
+        with self.hedge_lock:
+            latencies = sorted(self.latencies)
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def reserve_hedge(self):
+        """Count a hedged GET if that stays within the hedge budget"""
+
+        with self.hedge_lock:
+            if self.hedge_count + 1 > self.max_hedge_ratio * self.get_count:
+                return False
+            self.hedge_count += 1
+            return True
+
+    def send(self, method, url, **kwargs):
+        """Send a single request, or replay it from the cassette"""
+
+        kwargs.setdefault('timeout', self.timeout)
+        if self.cassette is not None and self.cassette.mode == 'replay':
+            return self.cassette.replay(method, url, **kwargs)
+        started = time.time()
+        r = self.transmit(method, url, **kwargs)
+        if self.cassette is not None:
+            self.cassette.record(method, url, kwargs, r,
+                time.time() - started, [self.access_token])
+        return r
+
+    def transmit(self, method, url, **kwargs):
+        """Send a single request over the network, hedging slow GETs with a
+        duplicate and taking whichever response arrives first
+        """
+
+        if method != 'GET' or not self.hedge:
+            return self.session.request(method, url, **kwargs)
+        started = time.time()
+        delay = self.get_hedge_delay()
+        with self.hedge_lock:
+            self.get_count += 1
+        results = Queue.Queue()
+
+        def attempt():
+            try:
+                results.put((True, self.session.request(method, url, **kwargs)))
+            except Exception as e:
+                results.put((False, e))
+
+        def start_attempt():
+            thread = threading.Thread(target=attempt)
+            thread.daemon = True
+            thread.start()
+
+        start_attempt()
+        attempts = 1
+        outcomes = []
+        if delay is not None:
+            try:
+                outcomes.append(results.get(timeout=delay))
+            except Queue.Empty:
+                if self.reserve_hedge():
+                    logging.info('Hedging slow GET {url}'.format(url=url))
+                    self.throttle()
+                    start_attempt()
+                    attempts += 1
+        while (not any(ok for ok, r in outcomes) and
+               len(outcomes) < attempts):
+            outcomes.append(results.get())
+        for ok, r in outcomes:
+            if ok:
+                with self.hedge_lock:
+                    self.latencies.append(time.time() - started)
+                return r
+        raise outcomes[0][1]
+
+    def throttle(self):
+        """Wait for the next request slot under the rate limit"""
+
+        if not self.requests_per_second:
+            return
+        with self.throttle_lock:
+            now = time.time()
+            wait = self.next_request_at - now
+            self.next_request_at = (
+                max(now, self.next_request_at) + 1.0 / self.requests_per_second
+            )
+        if wait > 0:
+            time.sleep(wait)
+
+    def request(self, method, endpoint, **kwargs):
+        """Send a request, retrying when the account is rate limited"""
 
         url = '{base_url}{endpoint}'.format(
             base_url=self.base_url,
             endpoint=endpoint
         )
-        payload['limit'] = 100
-        r = requests.get(url, params=payload, headers=self.headers)
-        if r.status_code == 200:
-            r = r.json()
-            # Handle pagination if over 100 resources returned
-            # Try/except for cases where getting a single resource
+        for attempt in range(self.max_rate_limit_retries + 1):
+            self.throttle()
+            with self.in_flight_lock:
+                self.in_flight += 1
             try:
-                if r['more']:
-                    payload['offset'] = 100
-                    output = r
-                    while r['more']:
-                        logging.info('GET pagination...')
-                        r = requests.get(
-                            url,
-                            params=payload,
-                            headers=self.headers
-                        ).json()
-                        for i in r[resource]:
-                            output[resource].append(i)
-                        payload['offset'] += 100
-                    r = output
-                return r
-            except:
-                return r
+                r = self.send(method, url, **kwargs)
+            finally:
+                with self.in_flight_lock:
+                    self.in_flight -= 1
+            if r.status_code != 429:
+                break
+            wait = float(r.headers.get('Retry-After') or 2 ** attempt)
+            logging.warning('Rate limited, retrying in {wait}s'.format(
+                wait=wait
+            ))
+            time.sleep(wait)
+        return r
+
+    def get(self, endpoint, payload=None, resource=None):
+        """Handle all GET requests"""
+
+        payload = dict(payload or {})
+        payload.setdefault('limit', 100)
+        # The total lets progress estimate how long the listing takes
+        if self.progress is not None:
+            payload.setdefault('total', 'true')
+        r = self.get_page(endpoint, payload)
+        # Handle pagination if over 100 resources returned
+        if r.get('more'):
+            resource = resource or endpoint.strip('/').split('/')[-1]
+            phase = 'GET {endpoint}'.format(endpoint=endpoint)
+            if self.progress is not None:
+                self.progress.start(phase, r.get('total'))
+                self.progress.advance(phase, len(r[resource]))
+            payload['offset'] = payload.get('offset', 0) + len(r[resource])
+            for page in self.iter_pages(endpoint, payload, resource):
+                r[resource].extend(page)
+                if self.progress is not None:
+                    self.progress.advance(phase, len(page))
+            if self.progress is not None:
+                self.progress.end(phase)
+            r['more'] = False
+        return r
+
+    def get_page(self, endpoint, payload=None):
+        """Handle a single GET request without following pagination"""
+
+        r = self.request('GET', endpoint, params=payload, headers=self.headers)
+        if r.status_code == 200:
+            return self.codec.loads(r.content)
         else:
             raise Exception(
                 'There was an issue with your GET request:\nStatus code: {code}\
                 \nError: {error}'.format(code=r.status_code, error=r.text)
             )
 
+    def iter_pages(self, endpoint, payload=None, resource=None):
+        """Handle paginated GET requests, yielding one page at a time"""
+
+        payload = dict(payload or {})
+        payload.setdefault('limit', 100)
+        payload.setdefault('offset', 0)
+        resource = resource or endpoint.strip('/').split('/')[-1]
+        while True:
+            r = self.get_page(endpoint, payload)
+            if not r[resource]:
+                return
+            yield r[resource]
+            if not r.get('more'):
+                return
+            logging.info('GET pagination...')
+            payload['offset'] += len(r[resource])
+
     def put(self, endpoint, payload=None, from_header=None):
         """Handle all PUT requests"""
 
-        url = '{base_url}{endpoint}'.format(
-            base_url=self.base_url,
-            endpoint=endpoint
-        )
         headers = dict(self.headers)
         headers['Content-Type'] = 'application/json'
         if from_header:
             headers['From'] = from_header
         if payload:
-            r = requests.put(
-                url,
-                data=json.dumps(payload),
+            r = self.request(
+                'PUT',
+                endpoint,
+                data=self.codec.dumps(payload),
                 headers=headers
             )
         else:
-            r = requests.put(url, headers=headers)
+            r = self.request('PUT', endpoint, headers=headers)
         if r.status_code == 200 or r.status_code == 204:
             return r.status_code
         else:
@@ -109,11 +321,7 @@ class PagerDutyREST():
     def delete(self, endpoint):
         """Handle all DELETE requests"""
 
-        url = '{base_url}{endpoint}'.format(
-            base_url=self.base_url,
-            endpoint=endpoint
-        )
-        r = requests.delete(url, headers=self.headers)
+        r = self.request('DELETE', endpoint, headers=self.headers)
         if r.status_code == 204:
             return r.status_code
         else:
@@ -125,280 +333,2317 @@ class PagerDutyREST():
     def post(self, endpoint, payload, from_header=None):
         """Handle all POST requests"""
 
-        url = '{base_url}{endpoint}'.format(
-            base_url=self.base_url,
-            endpoint=endpoint
-        )
         headers = dict(self.headers)
         headers['Content-Type'] = 'application/json'
         if from_header:
             headers['From'] = from_header
-        r = requests.post(url, headers=headers, data=json.dumps(payload))
+        r = self.request(
+            'POST',
+            endpoint,
+            headers=headers,
+            data=self.codec.dumps(payload)
+        )
         if r.status_code == 201:
-            return r.json()
+            return self.codec.loads(r.content)
         else:
             raise Exception(
                 'There was an issue with your POST request:\nStatus code: {code}\
                 \nError: {error}'.format(code=r.status_code, error=r.text)
             )
 
-def input_yn(message):
-    """Prompt for a yes or no
+def get_request_key(method, url, params=None):
+    """Get the key a request is recorded under in a cassette
 
-    Summary: Prompt a y/n question
+    Summary: Identify a request by its method, path and sorted query,
+        leaving out the since and until times, which change on every run
     Attributes:
-        @param (prompt): question requiring y/n answer from user
-    Returns: Boolean value of the user's answer
+        @param (method): HTTP method
+        @param (url): full URL of the request
+        @param (params): dict of query parameters sent with the request
+    Returns: string key of the request
     """
-    response = raw_input(message+" (y/n): ").strip().lower()
-    valid_responses = ('n', 'y')
-    if response and response[0] in valid_responses:
-        return bool(valid_responses.index(response))
-    else:
-        return input_yn(message)
 
-class DeleteUser():
-    """Class to handle all user deletion logic"""
+    prepared = requests.Request(method, url, params=params).prepare()
+    path, query = urlparse.urlsplit(prepared.url)[2:4]
+    query = sorted(
+        x for x in urlparse.parse_qsl(query, keep_blank_values=True)
+        if x[0] not in ('since', 'until')
+    )
+    return '{method} {path}?{query}'.format(
+        method=method,
+        path=path,
+        query=urllib.urlencode(query)
+    )
 
-    def __init__(self, access_token):
-        self.pd_rest = PagerDutyREST(access_token)
+class Cassette():
+    """Recording of API requests and responses that PagerDutyREST can replay
+    offline with the recorded latencies
 
-    def get_user_id(self, email):
-        """Get PagerDuty user ID from user email"""
+    Requests are matched on their method, path and query. Requests with the
+    same key are replayed in the order they were recorded, whatever their
+    bodies, since bodies carry timestamps that change on every run.
+    """
 
-        r = self.pd_rest.get('/users', {'query': email})
-        for user in r['users']:
-            if user['email'] == email:
-                return user['id']
-        raise ValueError(
-            'Could not find user with email {email}'.format(email=email)
-        )
+    # Response headers worth keeping, e.g. for rate limit retries
+    response_headers = ('Content-Type', 'Retry-After')
 
-    def list_open_incidents(self, user_id):
-        """Get any open incidents assigned to the user"""
+    def __init__(self, filename, mode='replay', latency_scale=1.0):
+        self.filename = filename
+        self.mode = mode
+        # Multiplies recorded latencies when replaying, 0 to not wait at all
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.interactions = {}
+        if mode == 'replay':
+            with open(filename) as cassette_file:
+                for line in cassette_file:
+                    if line.strip():
+                        interaction = json.loads(line)
+                        self.interactions.setdefault(
+                            interaction['key'],
+                            collections.deque()
+                        ).append(interaction)
 
-        r = self.pd_rest.get('/incidents', {
-            'total': True,
-            'statuses[]': ['triggered', 'acknowledged'],
-            'user_ids[]': user_id,
-            # 'date_range': 'all',
-            # 'urgencies[]': 'suppressed',
-            # 'with_suppressed': True,
-            # 'service_ids[]': 'INSERT_ID',
-        })
-        return r
+    def record(self, method, url, kwargs, r, latency, secrets=()):
+        """Append a request and its response, with any secrets scrubbed"""
 
-    def resolve_incidents(self, incidents, from_email):
-        """Resolves all incidents"""
+        def scrub(text):
+            for secret in secrets:
+                text = text.replace(secret, 'SCRUBBED')
+            return text
 
-        for incident in incidents:
-            logging.info('Resolving {id}'.format(id=incident))
-            try:
-                self.resolve_open_incident(incident, from_email)
-            except:
-                logging.error(
-                    'Could not resolve incident {id}'.format(id=incident)
-                )
+        interaction = {
+            'key': scrub(get_request_key(method, url, kwargs.get('params'))),
+            'body': scrub(kwargs.get('data') or '') or None,
+            'status_code': r.status_code,
+            'headers': dict(
+                (x, r.headers[x]) for x in self.response_headers
+                if x in r.headers
+            ),
+            'text': scrub(r.text),
+            'latency': latency
+        }
+        with self.lock:
+            with open(self.filename, 'a') as cassette_file:
+                cassette_file.write(json.dumps(interaction) + '\n')
 
-    def resolve_open_incident(self, incident_id, from_email):
-        """Resolves an incident"""
+    def replay(self, method, url, **kwargs):
+        """Get the recorded response to a request after its recorded latency"""
 
-        payload = {
-            'incident': {
-                'type': 'incident_reference',
-                'status': 'resolved'
-            }
-        }
-        r = self.pd_rest.put(
-            '/incidents/{id}'.format(id=incident_id),
-            payload,
-            from_email
-        )
+        key = get_request_key(method, url, kwargs.get('params'))
+        with self.lock:
+            if not self.interactions.get(key):
+                raise Exception(
+                    'No recorded response for {key}'.format(key=key)
+                )
+            interaction = self.interactions[key].popleft()
+        time.sleep(interaction['latency'] * self.latency_scale)
+        r = requests.Response()
+        r.status_code = interaction['status_code']
+        r.headers.update(interaction['headers'])
+        r._content = interaction['text'].encode('utf-8')
+        r.encoding = 'utf-8'
+        r.url = url
         return r
 
-    def list_schedules(self):
-        """Outputs list of all schedules"""
+    def count_unplayed(self):
+        """Count the recorded responses that were never replayed"""
 
-        r = self.pd_rest.get('/schedules')
-        return r['schedules']
+        with self.lock:
+            return sum(len(x) for x in self.interactions.values())
 
-    def list_teams(self):
-        """Outputs list of all teams"""
+class ServiceIndex():
+    """Index of the services that use each escalation policy"""
 
-        r = self.pd_rest.get('/teams')
-        return r['teams']
+    def __init__(self, services=None):
+        self.services_by_escalation_policy = {}
+        if services:
+            self.add_services(services)
 
-    def list_users_on_team(self, team_id):
-        """List all users on a particular team"""
+    def add_services(self, services):
+        """Add services to the index"""
 
-        r = self.pd_rest.get('/users', {'team_ids[]': team_id})
-        return r['users']
+        for service in services:
+            escalation_policy = service.get('escalation_policy')
+            if not escalation_policy:
+                continue
+            self.services_by_escalation_policy.setdefault(
+                escalation_policy['id'],
+                []
+            ).append({
+                'id': service['id'],
+                'name': service.get('name', service.get('summary'))
+            })
+        return self
 
-    def list_user_escalation_policies(self, user_id):
-        """List all escalation policies user is on"""
+    def get_blocking_services(self, escalation_policy_id):
+        """Get the services that prevent an escalation policy from being
+        deleted
+        """
 
-        r = self.pd_rest.get(
-            '/escalation_policies',
-            {'user_ids[]': user_id}
-        )
-        return r['escalation_policies']
+        return self.services_by_escalation_policy.get(escalation_policy_id, [])
 
-    def get_schedule(self, schedule_id):
-        """Get a single schedule"""
+    def can_delete_escalation_policy(self, escalation_policy_id):
+        """Check if no services use an escalation policy"""
 
-        r = self.pd_rest.get('/schedules/{id}'.format(id=schedule_id))
-        return r['schedule']
+        return not self.get_blocking_services(escalation_policy_id)
 
-    def get_escalation_policy(self, escalation_policy_id):
-        """Get a single escalation policy"""
+    def remove_service(self, service_id):
+        """Remove a service from the index"""
 
-        r = self.pd_rest.get(
-            '/escalation_policies/{id}'.format(id=escalation_policy_id)
-        )
-        return r['escalation_policy']
+        for escalation_policy_id, services in (
+            self.services_by_escalation_policy.items()
+        ):
+            self.services_by_escalation_policy[escalation_policy_id] = [
+                x for x in services if x['id'] != service_id
+            ]
+        return self
 
-    def check_schedule_for_user(self, user_id, schedule):
-        """Check if a schedule contains a particular user"""
+class UserDirectory():
+    """Index of user IDs by email address"""
 
-        for user in schedule['users']:
-            if user['id'] == user_id:
-                return True
-        return False
+    def __init__(self, users=None):
+        self.ids_by_email = {}
+        if users:
+            self.add_users(users)
 
-    def check_team_for_user(self, user_id, team_users):
-        """Check the users on a team for the deletion user"""
+    def add_users(self, users):
+        """Add users to the directory"""
 
-        for user in team_users:
-            if user['id'] == user_id:
-                return True
-        return False
+        for user in users:
+            self.ids_by_email[user['email'].lower()] = user['id']
+        return self
 
-    def get_user_layer_index(self, user_id, schedule_layer):
-        """Get the index of a user on a schedule layer"""
+    def get_user_id(self, email):
+        """Get PagerDuty user ID from user email"""
 
-        for i, user in enumerate(schedule_layer['users']):
-            # TODO: Fix once endpoint is fixed
-            if user['user']['id'] == user_id:
-                return i
-        return None
+        try:
+            return self.ids_by_email[email.lower()]
+        except KeyError:
+            raise ValueError(
+                'Could not find user with email {email}'.format(email=email)
+            )
 
-    def get_target_indices(self, id, escalation_rules):
-        """Get the escalation rule indices and target indices for the user or
-        schedule
+    def get_user_ids(self, emails, skip_missing=False):
+        """Get PagerDuty user IDs for several user emails, leaving out the
+        emails not found if skip_missing is set
         """
 
-        output = []
-        for i, rule in enumerate(escalation_rules):
-            for j, target in enumerate(rule['targets']):
-                if target['id'] == id:
-                    output.append({'rule': i, 'target': j})
-        return output
-
-    def remove_user_from_layer(self, index, schedule_layer):
-        """Remove a user from a schedule layer"""
+        user_ids = {}
+        for email in emails:
+            try:
+                user_ids[email] = self.get_user_id(email)
+            except ValueError:
+                if not skip_missing:
+                    raise
+        return user_ids
 
-        del schedule_layer['users'][index]
-        return schedule_layer
+class MembershipIndex():
+    """Index of the schedules, escalation policies and teams each user is on
 
-    def remove_from_escalation_policy(self, indices, escalation_rules):
-        """Remove a user or schedule from an escalation policy"""
+    The index holds full schedule and escalation policy objects so that a
+    warm process can plan a deprovision without any discovery reads.
+    """
 
-        for index in indices:
-            del escalation_rules[index['rule']]['targets'][index['target']]
-        return escalation_rules
+    def __init__(self):
+        self.schedules = {}
+        self.escalation_policies = {}
+        self.teams = {}
+        self.schedules_by_user = {}
+        self.escalation_policies_by_target = {}
+        self.teams_by_user = {}
 
-    def remove_user_from_team(self, team_id, user_id):
-        """Remove a user from a team"""
+    def get_schedule_user_ids(self, schedule):
+        """Get the IDs of the users on a schedule"""
 
-        r = self.pd_rest.delete(
-            '/teams/{team_id}/users/{user_id}'.format(
-                team_id=team_id,
-                user_id=user_id
-            )
+        if 'users' in schedule:
+            return set(user['id'] for user in schedule['users'])
+        return set(
+            user['user']['id']
+            for layer in schedule.get('schedule_layers', [])
+            for user in layer['users']
         )
-        return r
 
-    def update_schedule(self, schedule_id, schedule):
-        """Updates the schedule"""
+    def get_escalation_policy_target_ids(self, escalation_policy):
+        """Get the IDs of the users and schedules an escalation policy targets"""
 
-        payload = {
-            'schedule': schedule
-        }
-        r = self.pd_rest.put(
-            '/schedules/{id}'.format(id=schedule_id),
-            payload
+        return set(
+            target['id']
+            for rule in escalation_policy['escalation_rules']
+            for target in rule['targets']
         )
-        return r
 
-    def delete_schedule(self, schedule_id):
-        """Deletes the schedule"""
+    def add_schedule(self, schedule):
+        """Add or replace a schedule"""
 
-        r = self.pd_rest.delete('/schedules/{id}'.format(id=schedule_id))
-        return r
+        self.remove_schedule(schedule['id'])
+        self.schedules[schedule['id']] = copy.deepcopy(schedule)
+        for user_id in self.get_schedule_user_ids(schedule):
+            self.schedules_by_user.setdefault(user_id, set()).add(
+                schedule['id']
+            )
+        return self
 
-    def create_schedule(self, schedule):
-        """Creates the schedule"""
+    def remove_schedule(self, schedule_id):
+        """Remove a schedule"""
 
-        r = self.pd_rest.post(
-            '/schedules',
-            schedule
-        )
-        return r
+        schedule = self.schedules.pop(schedule_id, None)
+        if schedule is not None:
+            for user_id in self.get_schedule_user_ids(schedule):
+                self.schedules_by_user.get(user_id, set()).discard(schedule_id)
+        return self
 
-    def update_escalation_policy(self, escalation_policy_id, ep):
-        """Updates the escalation policy"""
+    def add_escalation_policy(self, escalation_policy):
+        """Add or replace an escalation policy"""
 
-        # Delete description in case it is null
-        del ep['description']
-        payload = {
-            'escalation_policy': ep
-        }
-        r = self.pd_rest.put(
-            '/escalation_policies/{id}'.format(id=escalation_policy_id),
-            payload
+        self.remove_escalation_policy(escalation_policy['id'])
+        self.escalation_policies[escalation_policy['id']] = copy.deepcopy(
+            escalation_policy
         )
-        return r
+        for target_id in self.get_escalation_policy_target_ids(
+            escalation_policy
+        ):
+            self.escalation_policies_by_target.setdefault(
+                target_id,
+                set()
+            ).add(escalation_policy['id'])
+        return self
 
-    def delete_escalation_policy(self, escalation_policy_id):
-        """Deletes the escalation policy"""
+    def remove_escalation_policy(self, escalation_policy_id):
+        """Remove an escalation policy"""
 
-        r = self.pd_rest.delete(
-            '/escalation_policies/{id}'.format(id=escalation_policy_id)
+        escalation_policy = self.escalation_policies.pop(
+            escalation_policy_id,
+            None
         )
-        return r
+        if escalation_policy is not None:
+            for target_id in self.get_escalation_policy_target_ids(
+                escalation_policy
+            ):
+                self.escalation_policies_by_target.get(
+                    target_id,
+                    set()
+                ).discard(escalation_policy_id)
+        return self
 
-    def create_escalation_policy(self, escalation_policy):
-        """Creates the escalation policy"""
+    def add_team(self, team, team_users):
+        """Add or replace a team and its members"""
 
-        payload = {
-            'escalation_policy': escalation_policy
+        self.remove_team(team['id'])
+        self.teams[team['id']] = {
+            'id': team['id'],
+            'name': team['name'],
+            'users': set(user['id'] for user in team_users)
         }
-        r = self.pd_rest.post(
-            '/escalation_policies',
-            payload
-        )
-        return r
+        for user_id in self.teams[team['id']]['users']:
+            self.teams_by_user.setdefault(user_id, set()).add(team['id'])
+        return self
 
-    def cache_schedule(self, schedule, cache):
-        """Adds current schedule to the cache of affected schedules"""
+    def remove_team(self, team_id):
+        """Remove a team"""
 
-        cache.append({
-            'id': schedule['id'],
-            'name': schedule['name']
-        })
-        return cache
+        team = self.teams.pop(team_id, None)
+        if team is not None:
+            for user_id in team['users']:
+                self.teams_by_user.get(user_id, set()).discard(team_id)
+        return self
 
-    def cache_team(self, team, cache):
-        """Adds current team to the cache of affected teams"""
+    def add_team_user(self, team_id, user_id):
+        """Add a user to a team"""
 
-        cache.append({
-            'id': team['id'],
-            'name': team['name']
-        })
-        return cache
+        if team_id in self.teams:
+            self.teams[team_id]['users'].add(user_id)
+            self.teams_by_user.setdefault(user_id, set()).add(team_id)
+        return self
 
-    def cache_escalation_policy(self, escalation_policy, cache):
-        """Adds current escalation policy to the cache of affected EPs"""
+    def remove_team_user(self, team_id, user_id):
+        """Remove a user from a team"""
+
+        if team_id in self.teams:
+            self.teams[team_id]['users'].discard(user_id)
+        self.teams_by_user.get(user_id, set()).discard(team_id)
+        return self
+
+    def remove_user(self, user_id):
+        """Remove a deleted user from every team"""
+
+        for team_id in list(self.teams_by_user.get(user_id, set())):
+            self.remove_team_user(team_id, user_id)
+        self.teams_by_user.pop(user_id, None)
+        return self
+
+    def get_escalation_policy(self, escalation_policy_id):
+        """Get a copy of a single escalation policy, if indexed"""
+
+        escalation_policy = self.escalation_policies.get(escalation_policy_id)
+        return copy.deepcopy(escalation_policy)
+
+    def get_schedules_for_user(self, user_id):
+        """Get copies of the schedules a user is on"""
+
+        return sorted(
+            [copy.deepcopy(self.schedules[x])
+             for x in self.schedules_by_user.get(user_id, set())],
+            key=lambda x: x['name']
+        )
+
+    def get_escalation_policies_for_user(self, user_id):
+        """Get copies of the escalation policies that target a user"""
+
+        return sorted(
+            [copy.deepcopy(self.escalation_policies[x])
+             for x in self.escalation_policies_by_target.get(user_id, set())],
+            key=lambda x: x['name']
+        )
+
+    def get_escalation_policies_for_schedule(self, schedule_id):
+        """Get copies of the escalation policies that target a schedule"""
+
+        return sorted(
+            [copy.deepcopy(self.escalation_policies[x])
+             for x in self.escalation_policies_by_target.get(
+                 schedule_id,
+                 set()
+             )],
+            key=lambda x: x['name']
+        )
+
+    def get_teams_for_user(self, user_id):
+        """Get the teams a user is on"""
+
+        return sorted(
+            [{'id': self.teams[x]['id'], 'name': self.teams[x]['name']}
+             for x in self.teams_by_user.get(user_id, set())],
+            key=lambda x: x['name']
+        )
+
+    def get_matrix(self):
+        """Get a MembershipMatrix of the indexed schedules, escalation
+        policies and teams, for checking many users at once
+        """
+
+        matrix = MembershipMatrix()
+        for schedule in self.schedules.values():
+            matrix.add_schedule(schedule)
+        for escalation_policy in self.escalation_policies.values():
+            matrix.add_escalation_policy(escalation_policy)
+        for team in self.teams.values():
+            matrix.add_team(team['id'], team['users'])
+        return matrix
+
+    def get_for_users(self, user_ids):
+        """Get the escalation policies, schedules and teams of several users
+        in one pass over a MembershipMatrix, keyed by user ID, in the shape
+        of the get_*_for_user methods
+        """
+
+        found = self.get_matrix().find(user_ids)
+        memberships = {}
+        for user_id in user_ids:
+            objects = found.get(user_id, [])
+            memberships[user_id] = {
+                'escalation_policies': sorted(
+                    [copy.deepcopy(self.escalation_policies[x['id']])
+                     for x in objects if x['type'] == 'escalation_policy'],
+                    key=lambda x: x['name']
+                ),
+                'schedules': sorted(
+                    [copy.deepcopy(self.schedules[x['id']])
+                     for x in objects if x['type'] == 'schedule'],
+                    key=lambda x: x['name']
+                ),
+                'teams': sorted(
+                    [{'id': self.teams[x['id']]['id'],
+                      'name': self.teams[x['id']]['name']}
+                     for x in objects if x['type'] == 'team'],
+                    key=lambda x: x['name']
+                )
+            }
+        return memberships
+
+class IDInterner():
+    """Map PagerDuty IDs to small integers, numbered in the order they are
+    first seen, so that a set of IDs can be held as the bits of one integer
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.numbers = {}
+
+    def intern(self, id):
+        """Get the number of an ID, numbering it if it is new"""
+
+        number = self.numbers.get(id)
+        if number is None:
+            number = self.numbers[id] = len(self.ids)
+            self.ids.append(id)
+        return number
+
+    def get_bits(self, ids):
+        """Get the bitset of some IDs, numbering any that are new"""
+
+        bits = 0
+        for id in ids:
+            bits |= 1 << self.intern(id)
+        return bits
+
+    def get_mask(self, ids):
+        """Get the bitset of the IDs already numbered, leaving out the rest"""
+
+        bits = 0
+        for id in ids:
+            number = self.numbers.get(id)
+            if number is not None:
+                bits |= 1 << number
+        return bits
+
+    def get_ids(self, bits):
+        """Get the IDs in a bitset, lowest number first"""
+
+        ids = []
+        while bits:
+            lowest = bits & -bits
+            ids.append(self.ids[lowest.bit_length() - 1])
+            bits ^= lowest
+        return ids
+
+class MembershipMatrix():
+    """Bitset matrix of the members of each schedule layer, escalation rule
+    and team, for finding which of many users are on which objects at once
+
+    Every row is an integer with a bit set for each interned member ID, so
+    checking a batch of users against a row is a single AND instead of a
+    string comparison per user and member.
+    """
+
+    def __init__(self, interner=None):
+        self.interner = interner or IDInterner()
+        # (type, ID) of each object -> bitset of all of its members, and the
+        # bitsets of its schedule layers or escalation rules
+        self.rows = {}
+
+    def add(self, kind, object_id, rows):
+        """Add or replace an object from the member IDs of each of its rows"""
+
+        rows = [self.interner.get_bits(x) for x in rows]
+        members = 0
+        for row in rows:
+            members |= row
+        self.rows[(kind, object_id)] = (members, rows)
+        return self
+
+    def add_schedule(self, schedule):
+        """Add or replace a schedule, with a row for each layer"""
+
+        return self.add('schedule', schedule['id'], [
+            [user['user']['id'] for user in layer['users']]
+            for layer in schedule.get('schedule_layers', [])
+        ])
+
+    def add_escalation_policy(self, escalation_policy):
+        """Add or replace an escalation policy, with a row for each rule"""
+
+        return self.add('escalation_policy', escalation_policy['id'], [
+            [target['id'] for target in rule['targets']]
+            for rule in escalation_policy['escalation_rules']
+        ])
+
+    def add_team(self, team_id, user_ids):
+        """Add or replace a team and its members"""
+
+        return self.add('team', team_id, [user_ids])
+
+    def remove(self, kind, object_id):
+        """Remove an object"""
+
+        self.rows.pop((kind, object_id), None)
+        return self
+
+    def find(self, user_ids, kinds=None):
+        """Find which of some users are on which objects
+
+        Summary: Check every object against all of the users at once, and
+            only look at the rows of the objects with any of them on
+        Attributes:
+            @param (user_ids): IDs of the users, or of schedules to find in
+                escalation rules
+            @param (kinds): types of object to look in, defaulting to all
+        Returns: dict of each ID found to a list of the objects it is on, as
+            {"type": ..., "id": ..., "rows": [...]} with the indices of the
+            schedule layers or escalation rules it is in
+        """
+
+        mask = self.interner.get_mask(user_ids)
+        found = {}
+        for (kind, object_id), (members, rows) in self.rows.items():
+            if not members & mask or (kinds and kind not in kinds):
+                continue
+            indices = {}
+            for i, row in enumerate(rows):
+                for user_id in self.interner.get_ids(row & mask):
+                    indices.setdefault(user_id, []).append(i)
+            for user_id, rows_found in indices.items():
+                found.setdefault(user_id, []).append({
+                    'type': kind,
+                    'id': object_id,
+                    'rows': rows_found
+                })
+        for objects in found.values():
+            objects.sort(key=lambda x: (x['type'], x['id']))
+        return found
+
+class AccountSnapshot():
+    """Indexed SQLite snapshot of the schedules, escalation policies, teams,
+    services and users in an account
+
+    It answers the same queries as MembershipIndex and ServiceIndex, so a
+    deprovision can be planned from it without discovery reads, and it is
+    kept current with the writes made through DeleteUser.
+    """
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY, email TEXT, name TEXT
+        );
+        CREATE INDEX IF NOT EXISTS users_email ON users (email);
+        CREATE TABLE IF NOT EXISTS schedules (
+            id TEXT PRIMARY KEY, name TEXT, body TEXT
+        );
+        CREATE TABLE IF NOT EXISTS schedule_layers (
+            schedule_id TEXT, layer_index INTEGER, layer_id TEXT, name TEXT,
+            start_time TEXT, end_time TEXT,
+            PRIMARY KEY (schedule_id, layer_index)
+        );
+        CREATE TABLE IF NOT EXISTS layer_users (
+            schedule_id TEXT, layer_index INTEGER, position INTEGER,
+            user_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS layer_users_user ON layer_users (user_id);
+        CREATE INDEX IF NOT EXISTS layer_users_schedule
+            ON layer_users (schedule_id);
+        CREATE TABLE IF NOT EXISTS escalation_policies (
+            id TEXT PRIMARY KEY, name TEXT, body TEXT
+        );
+        CREATE TABLE IF NOT EXISTS rule_targets (
+            escalation_policy_id TEXT, rule_index INTEGER,
+            target_index INTEGER, target_id TEXT, target_type TEXT
+        );
+        CREATE INDEX IF NOT EXISTS rule_targets_target
+            ON rule_targets (target_id);
+        CREATE INDEX IF NOT EXISTS rule_targets_escalation_policy
+            ON rule_targets (escalation_policy_id);
+        CREATE TABLE IF NOT EXISTS teams (id TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS team_users (
+            team_id TEXT, user_id TEXT, PRIMARY KEY (team_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS team_users_user ON team_users (user_id);
+        CREATE TABLE IF NOT EXISTS services (
+            id TEXT PRIMARY KEY, name TEXT, escalation_policy_id TEXT
+        );
+        CREATE INDEX IF NOT EXISTS services_escalation_policy
+            ON services (escalation_policy_id);
+    '''
+
+    # Audit records further back than this may have left the feed, so an
+    # older snapshot is taken again in full
+    max_audit_age = 30 * 24 * 3600
+    # Seconds of audit records read again on each refresh, in case the
+    # clocks here and at PagerDuty disagree
+    audit_overlap = 60
+
+    def __init__(self, filename):
+        # Changes are written from a pipeline thread, one at a time
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.executescript(self.schema)
+
+    def take(self, delete_user):
+        """Replace the snapshot with the current state of the account"""
+
+        started = time.time()
+        for table in ('users', 'schedules', 'schedule_layers', 'layer_users',
+                      'escalation_policies', 'rule_targets', 'teams',
+                      'team_users', 'services'):
+            self.db.execute('DELETE FROM {table}'.format(table=table))
+        for user in delete_user.list_users():
+            self.insert_user(user)
+        logging.info('GOT users for snapshot')
+        for sched in delete_user.list_schedules():
+            self.insert_schedule(delete_user.get_schedule(sched['id']))
+        logging.info('GOT schedules for snapshot')
+        for ep in delete_user.list_escalation_policies():
+            self.insert_escalation_policy(ep)
+        logging.info('GOT escalation policies for snapshot')
+        for team in delete_user.list_teams():
+            self.insert_team(team, delete_user.list_users_on_team(team['id']))
+        logging.info('GOT teams for snapshot')
+        for service in delete_user.list_services():
+            self.insert_service(service)
+        logging.info('GOT services for snapshot')
+        self.set_meta('taken_at', datetime.now().isoformat())
+        self.set_audit_since(started)
+        self.db.commit()
+        return self
+
+    def refresh(self, delete_user):
+        """Bring the snapshot up to date from the audit records of changes
+        made since the last refresh, taking it again in full if there is no
+        high-water mark, it is too old, or the records cannot be applied
+        """
+
+        started = time.time()
+        since = self.get_meta('audit_since')
+        if since is None or (
+                started - parse_timestamp(since) > self.max_audit_age):
+            logging.info('No recent audit high-water mark, taking a full '
+                'snapshot')
+            return self.take(delete_user)
+        try:
+            changes = self.apply_audit_records(
+                delete_user,
+                delete_user.iter_audit_records(since)
+            )
+        except Exception as e:
+            self.db.rollback()
+            logging.warning('Could not refresh the snapshot from audit '
+                'records since {since}, taking a full snapshot: {error}'
+                .format(since=since, error=e))
+            return self.take(delete_user)
+        logging.info('Refreshed {count} objects changed since {since}'.format(
+            count=changes,
+            since=since
+        ))
+        self.set_audit_since(started)
+        self.db.commit()
+        return self
+
+    def apply_audit_records(self, delete_user, records):
+        """Fetch again, or remove, every object changed by audit records,
+        without committing, and return how many there were
+        """
+
+        changes = collections.OrderedDict()
+        for record in sorted(records, key=lambda x: x['execution_time']):
+            resource = record['root_resource']
+            key = (resource['type'].replace('_reference', ''), resource['id'])
+            # Only the latest change to each object matters
+            changes.pop(key, None)
+            changes[key] = record['action']
+        for (resource_type, resource_id), action in changes.items():
+            if resource_type == 'user':
+                if action == 'delete':
+                    self.db.execute('DELETE FROM users WHERE id = ?',
+                        (resource_id,))
+                    self.db.execute('DELETE FROM team_users WHERE user_id = ?',
+                        (resource_id,))
+                else:
+                    self.insert_user(delete_user.get_user(resource_id))
+            elif resource_type == 'schedule':
+                if action == 'delete':
+                    self.delete_schedule(resource_id)
+                else:
+                    self.insert_schedule(delete_user.get_schedule(resource_id))
+            elif resource_type == 'escalation_policy':
+                if action == 'delete':
+                    self.delete_escalation_policy(resource_id)
+                else:
+                    self.insert_escalation_policy(delete_user.pd_rest.get(
+                        '/escalation_policies/{id}'.format(id=resource_id)
+                    )['escalation_policy'])
+            elif resource_type == 'team':
+                if action == 'delete':
+                    self.delete_team(resource_id)
+                else:
+                    self.insert_team(
+                        delete_user.pd_rest.get(
+                            '/teams/{id}'.format(id=resource_id)
+                        )['team'],
+                        delete_user.list_users_on_team(resource_id)
+                    )
+            elif resource_type == 'service':
+                if action == 'delete':
+                    self.db.execute('DELETE FROM services WHERE id = ?',
+                        (resource_id,))
+                else:
+                    self.insert_service(delete_user.get_service(resource_id))
+        return len(changes)
+
+    def get_meta(self, key):
+        """Get a value saved about the snapshot, or None"""
+
+        row = self.db.execute(
+            'SELECT value FROM meta WHERE key = ?',
+            (key,)
+        ).fetchone()
+        return row and row[0]
+
+    def set_meta(self, key, value):
+        """Save a value about the snapshot without committing"""
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+            (key, value)
+        )
+
+    def set_audit_since(self, started):
+        """Save the high-water mark for the next refresh without committing"""
+
+        self.set_meta('audit_since', datetime.utcfromtimestamp(
+            started - self.audit_overlap
+        ).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    def get_taken_at(self):
+        """Get when the snapshot was taken, or None if it is empty"""
+
+        return self.get_meta('taken_at')
+
+    def insert_user(self, user):
+        """Insert or replace a user without committing"""
+
+        self.db.execute(
+            'INSERT OR REPLACE INTO users VALUES (?, ?, ?)',
+            (user['id'], user['email'].lower(), user.get('name'))
+        )
+
+    def insert_schedule(self, schedule):
+        """Insert or replace a schedule and its layers without committing"""
+
+        self.delete_schedule(schedule['id'])
+        self.db.execute(
+            'INSERT INTO schedules VALUES (?, ?, ?)',
+            (schedule['id'], schedule['name'], json.dumps(schedule))
+        )
+        for i, layer in enumerate(schedule.get('schedule_layers', [])):
+            self.db.execute(
+                'INSERT INTO schedule_layers VALUES (?, ?, ?, ?, ?, ?)',
+                (schedule['id'], i, layer.get('id'), layer.get('name'),
+                 layer.get('start'), layer.get('end'))
+            )
+            self.db.executemany(
+                'INSERT INTO layer_users VALUES (?, ?, ?, ?)',
+                [(schedule['id'], i, j, user['user']['id'])
+                 for j, user in enumerate(layer['users'])]
+            )
+
+    def delete_schedule(self, schedule_id):
+        """Delete a schedule and its layers without committing"""
+
+        for table, column in (('schedules', 'id'),
+                              ('schedule_layers', 'schedule_id'),
+                              ('layer_users', 'schedule_id')):
+            self.db.execute(
+                'DELETE FROM {table} WHERE {column} = ?'.format(
+                    table=table,
+                    column=column
+                ),
+                (schedule_id,)
+            )
+
+    def insert_escalation_policy(self, escalation_policy):
+        """Insert or replace an escalation policy and its rules without
+        committing
+        """
+
+        self.delete_escalation_policy(escalation_policy['id'])
+        self.db.execute(
+            'INSERT INTO escalation_policies VALUES (?, ?, ?)',
+            (escalation_policy['id'], escalation_policy['name'],
+             json.dumps(escalation_policy))
+        )
+        self.db.executemany(
+            'INSERT INTO rule_targets VALUES (?, ?, ?, ?, ?)',
+            [(escalation_policy['id'], i, j, target['id'], target.get('type'))
+             for i, rule in enumerate(escalation_policy['escalation_rules'])
+             for j, target in enumerate(rule['targets'])]
+        )
+
+    def delete_escalation_policy(self, escalation_policy_id):
+        """Delete an escalation policy and its rules without committing"""
+
+        self.db.execute(
+            'DELETE FROM escalation_policies WHERE id = ?',
+            (escalation_policy_id,)
+        )
+        self.db.execute(
+            'DELETE FROM rule_targets WHERE escalation_policy_id = ?',
+            (escalation_policy_id,)
+        )
+
+    def insert_team(self, team, team_users):
+        """Insert or replace a team and its members without committing"""
+
+        self.delete_team(team['id'])
+        self.db.execute(
+            'INSERT INTO teams VALUES (?, ?)',
+            (team['id'], team['name'])
+        )
+        self.db.executemany(
+            'INSERT OR IGNORE INTO team_users VALUES (?, ?)',
+            [(team['id'], user['id']) for user in team_users]
+        )
+
+    def delete_team(self, team_id):
+        """Delete a team and its members without committing"""
+
+        self.db.execute('DELETE FROM teams WHERE id = ?', (team_id,))
+        self.db.execute('DELETE FROM team_users WHERE team_id = ?', (team_id,))
+
+    def insert_service(self, service):
+        """Insert or replace a service without committing"""
+
+        escalation_policy = service.get('escalation_policy') or {}
+        self.db.execute(
+            'INSERT OR REPLACE INTO services VALUES (?, ?, ?)',
+            (service['id'], service.get('name', service.get('summary')),
+             escalation_policy.get('id'))
+        )
+
+    def add_schedule(self, schedule):
+        """Add or replace a schedule"""
+
+        self.insert_schedule(schedule)
+        self.db.commit()
+        return self
+
+    def remove_schedule(self, schedule_id):
+        """Remove a schedule"""
+
+        self.delete_schedule(schedule_id)
+        self.db.commit()
+        return self
+
+    def add_escalation_policy(self, escalation_policy):
+        """Add or replace an escalation policy"""
+
+        self.insert_escalation_policy(escalation_policy)
+        self.db.commit()
+        return self
+
+    def remove_escalation_policy(self, escalation_policy_id):
+        """Remove an escalation policy"""
+
+        self.delete_escalation_policy(escalation_policy_id)
+        self.db.commit()
+        return self
+
+    def add_team(self, team, team_users):
+        """Add or replace a team and its members"""
+
+        self.insert_team(team, team_users)
+        self.db.commit()
+        return self
+
+    def remove_team(self, team_id):
+        """Remove a team"""
+
+        self.delete_team(team_id)
+        self.db.commit()
+        return self
+
+    def remove_team_user(self, team_id, user_id):
+        """Remove a user from a team"""
+
+        self.db.execute(
+            'DELETE FROM team_users WHERE team_id = ? AND user_id = ?',
+            (team_id, user_id)
+        )
+        self.db.commit()
+        return self
+
+    def remove_user(self, user_id):
+        """Remove a deleted user and their team memberships"""
+
+        self.db.execute('DELETE FROM users WHERE id = ?', (user_id,))
+        self.db.execute('DELETE FROM team_users WHERE user_id = ?', (user_id,))
+        self.db.commit()
+        return self
+
+    def add_services(self, services):
+        """Add or replace services"""
+
+        for service in services:
+            self.insert_service(service)
+        self.db.commit()
+        return self
+
+    def remove_service(self, service_id):
+        """Remove a service"""
+
+        self.db.execute('DELETE FROM services WHERE id = ?', (service_id,))
+        self.db.commit()
+        return self
+
+    def get_user_id(self, email):
+        """Get PagerDuty user ID from user email"""
+
+        row = self.db.execute(
+            'SELECT id FROM users WHERE email = ?',
+            (email.lower(),)
+        ).fetchone()
+        if row is None:
+            raise ValueError(
+                'Could not find user with email {email}'.format(email=email)
+            )
+        return row[0]
+
+    def get_escalation_policy(self, escalation_policy_id):
+        """Get a single escalation policy, if in the snapshot"""
+
+        row = self.db.execute(
+            'SELECT body FROM escalation_policies WHERE id = ?',
+            (escalation_policy_id,)
+        ).fetchone()
+        return row and json.loads(row[0])
+
+    def get_schedules_for_user(self, user_id):
+        """Get the schedules a user is on"""
+
+        rows = self.db.execute(
+            'SELECT body FROM schedules WHERE id IN ('
+            'SELECT schedule_id FROM layer_users WHERE user_id = ?) '
+            'ORDER BY name',
+            (user_id,)
+        )
+        return [json.loads(x[0]) for x in rows]
+
+    def get_escalation_policies_for_user(self, user_id):
+        """Get the escalation policies that target a user"""
+
+        rows = self.db.execute(
+            'SELECT body FROM escalation_policies WHERE id IN ('
+            'SELECT escalation_policy_id FROM rule_targets '
+            'WHERE target_id = ?) ORDER BY name',
+            (user_id,)
+        )
+        return [json.loads(x[0]) for x in rows]
+
+    def get_escalation_policies_for_schedule(self, schedule_id):
+        """Get the escalation policies that target a schedule"""
+
+        return self.get_escalation_policies_for_user(schedule_id)
+
+    def get_teams_for_user(self, user_id):
+        """Get the teams a user is on"""
+
+        rows = self.db.execute(
+            'SELECT id, name FROM teams WHERE id IN ('
+            'SELECT team_id FROM team_users WHERE user_id = ?) ORDER BY name',
+            (user_id,)
+        )
+        return [{'id': x[0], 'name': x[1]} for x in rows]
+
+    def get_blocking_services(self, escalation_policy_id):
+        """Get the services that prevent an escalation policy from being
+        deleted
+        """
+
+        rows = self.db.execute(
+            'SELECT id, name FROM services WHERE escalation_policy_id = ? '
+            'ORDER BY id',
+            (escalation_policy_id,)
+        )
+        return [{'id': x[0], 'name': x[1]} for x in rows]
+
+    def can_delete_escalation_policy(self, escalation_policy_id):
+        """Check if no services use an escalation policy"""
+
+        return not self.get_blocking_services(escalation_policy_id)
+
+class RollbackBundle():
+    """Full pre-images of the objects changed by a deprovision
+
+    Each pre-image is appended to a gzipped JSON lines file as soon as it is
+    captured, so a bundle survives a run that stops part way.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.captured = set()
+        self.lock = threading.Lock()
+
+    def add(self, object_type, obj):
+        """Append the pre-image of an object unless it is already captured"""
+
+        key = (object_type, obj['id'])
+        with self.lock:
+            if key in self.captured:
+                return False
+            self.captured.add(key)
+            with gzip.open(self.filename, 'ab') as bundle_file:
+                bundle_file.write(json.dumps({
+                    'type': object_type,
+                    'object': obj
+                }, separators=(',', ':')) + '\n')
+        return True
+
+    def load(self):
+        """Get the captured pre-images in the order they were captured"""
+
+        with gzip.open(self.filename, 'rb') as bundle_file:
+            return [json.loads(x) for x in bundle_file if x.strip()]
+
+def new_rollback_bundle(name):
+    """Start a timestamped rollback bundle in ./rollback"""
+
+    if not os.path.isdir(os.path.join(os.getcwd(), './rollback')):
+        os.mkdir(os.path.join(os.getcwd(), './rollback'))
+    return RollbackBundle('./rollback/{timestamp}_{name}.jsonl.gz'.format(
+        timestamp=datetime.now().isoformat(),
+        name=name
+    ))
+
+def remap_ids(obj, ids):
+    """Replace references to recreated objects with their new IDs"""
+
+    if isinstance(obj, dict):
+        return dict(
+            (k, ids.get(v, v) if k == 'id' else remap_ids(v, ids))
+            for k, v in obj.items()
+        )
+    if isinstance(obj, list):
+        return [remap_ids(x, ids) for x in obj]
+    return obj
+
+def run_parallel(function, items, workers=8):
+    """Call a function for each item on a pool of threads
+
+    Summary: Run a function concurrently over a list of items
+    Attributes:
+        @param (function): called with each item
+        @param (items): list of items
+        @param (workers): number of threads
+    Returns: list of (item, result, exception) tuples in the order of items
+    """
+
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for i in range(len(items)):
+        queue.put(i)
+
+    def work():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = (items[i], function(items[i]), None)
+            except Exception as e:
+                results[i] = (items[i], None, e)
+
+    threads = [
+        threading.Thread(target=work) for i in range(min(workers, len(items)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def rollback(access_token, bundle_filename, from_email, workers=8):
+    """Restore the objects in a rollback bundle
+
+    The user and deleted teams are recreated first, then schedules, then
+    the escalation policies that may reference them, then team memberships.
+    Each stage restores its objects concurrently. Deleted objects are
+    recreated with new IDs, and later stages are updated to use them.
+    """
+
+    init_logging()
+    pd_rest = PagerDutyREST(access_token)
+    records = RollbackBundle(bundle_filename).load()
+    ids = {}
+    ids_lock = threading.Lock()
+    report = {'restored': [], 'failed': []}
+
+    def exists(path):
+        r = pd_rest.request('GET', path, headers=pd_rest.headers)
+        if r.status_code not in (200, 404):
+            raise Exception(
+                'There was an issue with your GET request:\nStatus code: '
+                '{code}\nError: {error}'.format(code=r.status_code, error=r.text)
+            )
+        return r.status_code == 200
+
+    def restore_user(user):
+        if exists('/users/{id}'.format(id=user['id'])):
+            return
+        body = dict(
+            (k, user[k]) for k in ('type', 'name', 'email', 'time_zone',
+                                   'color', 'role', 'description',
+                                   'job_title')
+            if user.get(k) is not None
+        )
+        r = pd_rest.post('/users', {'user': body}, from_email)
+        with ids_lock:
+            ids[user['id']] = r['user']['id']
+
+    def restore_schedule(schedule):
+        with ids_lock:
+            body = remap_ids(schedule, ids)
+        for field in ('users', 'escalation_policies', 'final_schedule',
+                      'overrides_subschedule'):
+            body.pop(field, None)
+        # Layers are sent back in the reverse of the order they are read
+        body['schedule_layers'] = body['schedule_layers'][::-1]
+        if exists('/schedules/{id}'.format(id=schedule['id'])):
+            pd_rest.put(
+                '/schedules/{id}'.format(id=schedule['id']),
+                {'schedule': body}
+            )
+        else:
+            body.pop('id', None)
+            r = pd_rest.post('/schedules', {'schedule': body})
+            with ids_lock:
+                ids[schedule['id']] = r['schedule']['id']
+
+    def restore_escalation_policy(escalation_policy):
+        with ids_lock:
+            body = remap_ids(escalation_policy, ids)
+        if body.get('description') is None:
+            body.pop('description', None)
+        if exists('/escalation_policies/{id}'.format(
+                id=escalation_policy['id'])):
+            pd_rest.put(
+                '/escalation_policies/{id}'.format(id=escalation_policy['id']),
+                {'escalation_policy': body}
+            )
+        else:
+            body.pop('id', None)
+            r = pd_rest.post(
+                '/escalation_policies',
+                {'escalation_policy': body}
+            )
+            with ids_lock:
+                ids[escalation_policy['id']] = r['escalation_policy']['id']
+
+    def restore_team(team):
+        if exists('/teams/{id}'.format(id=team['id'])):
+            return
+        body = dict(
+            (k, team[k]) for k in ('type', 'name', 'description')
+            if team.get(k) is not None
+        )
+        r = pd_rest.post('/teams', {'team': body})
+        with ids_lock:
+            ids[team['id']] = r['team']['id']
+
+    def restore_team_membership(membership):
+        with ids_lock:
+            team_id = ids.get(membership['team_id'], membership['team_id'])
+            user_id = ids.get(membership['user_id'], membership['user_id'])
+        pd_rest.put('/teams/{team_id}/users/{user_id}'.format(
+            team_id=team_id,
+            user_id=user_id
+        ))
+
+    stages = (
+        ('user', restore_user),
+        ('team', restore_team),
+        ('schedule', restore_schedule),
+        ('escalation_policy', restore_escalation_policy),
+        ('team_membership', restore_team_membership)
+    )
+    for object_type, restore in stages:
+        objects = [x['object'] for x in records if x['type'] == object_type]
+        for obj, result, error in run_parallel(restore, objects, workers):
+            entry = {'type': object_type, 'id': obj['id']}
+            if error is None:
+                entry['new_id'] = ids.get(obj['id'], obj['id'])
+                report['restored'].append(entry)
+            else:
+                logging.error('Could not restore {type} {id}: {error}'.format(
+                    type=object_type,
+                    id=obj['id'],
+                    error=error
+                ))
+                entry['error'] = str(error)
+                report['failed'].append(entry)
+        logging.info('Restored {type} objects'.format(type=object_type))
+    return report
+
+def parse_timestamp(value):
+    """Convert an ISO 8601 timestamp from the API to seconds since the epoch,
+    reading timestamps without an offset as UTC
+    """
+
+    offset = 0
+    if value.endswith('Z'):
+        value = value[:-1]
+    elif len(value) > 19 and value[-6] in '+-' and value[-3] == ':':
+        offset = int(value[-5:-3]) * 3600 + int(value[-2:]) * 60
+        if value[-6] == '-':
+            offset = -offset
+        value = value[:-6]
+    moment = datetime.strptime(value.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    return calendar.timegm(moment.timetuple()) - offset
+
+def build_cleanup_plan(schedules, escalation_policies, teams, team_members,
+                       services, now=None):
+    """Plan the cleanup of orphaned objects in an account
+
+    Summary: Find schedules with no layers left in use, layers that have
+        ended, escalation policies with no targets left and teams with no
+        members, keeping any that services still depend on
+    Attributes:
+        @param (schedules): list of full schedules
+        @param (escalation_policies): list of full escalation policies
+        @param (teams): list of teams
+        @param (team_members): dict of the number of members of each team ID
+        @param (services): list of services
+        @param (now): seconds since the epoch, defaulting to the current time
+    Returns: dict of the actions to apply and the objects that are blocked
+    """
+
+    now = time.time() if now is None else now
+    service_index = ServiceIndex(services)
+    ended_layers = {}
+    empty_schedule_ids = set()
+    for schedule in schedules:
+        ended_layers[schedule['id']] = [
+            x['id'] for x in schedule['schedule_layers']
+            if x.get('end') and parse_timestamp(x['end']) <= now
+        ]
+        if not [x for x in schedule['schedule_layers']
+                if x['id'] not in ended_layers[schedule['id']] and x['users']]:
+            empty_schedule_ids.add(schedule['id'])
+    # An escalation policy that services still use cannot be left without
+    # targets, so the empty schedules it targets have to stay
+    blocked_schedule_ids = {}
+    blocked_escalation_policy_ids = set()
+    blocked_escalation_policies = []
+    while True:
+        for ep in escalation_policies:
+            targets = [
+                y['id'] for x in ep['escalation_rules'] for y in x['targets']
+            ]
+            if [x for x in targets if x not in empty_schedule_ids] or (
+                    ep['id'] in blocked_escalation_policy_ids):
+                continue
+            blocking_services = service_index.get_blocking_services(ep['id'])
+            if not blocking_services:
+                continue
+            blocked_escalation_policy_ids.add(ep['id'])
+            blocked_escalation_policies.append({
+                'type': 'escalation_policy',
+                'id': ep['id'],
+                'name': ep['name'],
+                'services': blocking_services
+            })
+            for x in targets:
+                blocked_schedule_ids.setdefault(x, ep['id'])
+        if not empty_schedule_ids & set(blocked_schedule_ids):
+            break
+        empty_schedule_ids -= set(blocked_schedule_ids)
+    actions = []
+    blocked = list(blocked_escalation_policies)
+    for schedule in schedules:
+        if schedule['id'] in empty_schedule_ids:
+            actions.append({
+                'action': 'delete_schedule',
+                'id': schedule['id'],
+                'name': schedule['name']
+            })
+        elif schedule['id'] in blocked_schedule_ids:
+            blocked.append({
+                'type': 'schedule',
+                'id': schedule['id'],
+                'name': schedule['name'],
+                'escalation_policy': blocked_schedule_ids[schedule['id']]
+            })
+        elif ended_layers[schedule['id']]:
+            actions.append({
+                'action': 'update_schedule',
+                'id': schedule['id'],
+                'name': schedule['name'],
+                'remove_layers': ended_layers[schedule['id']]
+            })
+    for ep in escalation_policies:
+        if ep['id'] in blocked_escalation_policy_ids:
+            continue
+        remove_targets = [
+            y['id'] for x in ep['escalation_rules'] for y in x['targets']
+            if y['id'] in empty_schedule_ids
+        ]
+        remaining_rules = [
+            x for x in ep['escalation_rules']
+            if [y for y in x['targets'] if y['id'] not in empty_schedule_ids]
+        ]
+        if not remaining_rules:
+            actions.append({
+                'action': 'delete_escalation_policy',
+                'id': ep['id'],
+                'name': ep['name']
+            })
+        elif remove_targets or (
+                len(remaining_rules) != len(ep['escalation_rules'])):
+            actions.append({
+                'action': 'update_escalation_policy',
+                'id': ep['id'],
+                'name': ep['name'],
+                'remove_targets': remove_targets
+            })
+    # Teams still owning services or escalation policies are kept
+    owners = {}
+    for x in services + escalation_policies:
+        for team in x.get('teams') or []:
+            owners.setdefault(team['id'], []).append(x['id'])
+    for team in teams:
+        if team_members.get(team['id']):
+            continue
+        if team['id'] in owners:
+            blocked.append({
+                'type': 'team',
+                'id': team['id'],
+                'name': team['name'],
+                'owns': owners[team['id']]
+            })
+        else:
+            actions.append({
+                'action': 'delete_team',
+                'id': team['id'],
+                'name': team['name']
+            })
+    return {'actions': actions, 'blocked': blocked}
+
+def plan_cleanup(delete_user, workers=8):
+    """Scan the whole account in parallel and plan the cleanup of orphaned
+    schedules, layers, escalation policies and teams
+    """
+
+    listings = run_parallel(lambda x: x(), [
+        delete_user.list_schedules,
+        delete_user.list_escalation_policies,
+        delete_user.list_teams,
+        delete_user.list_services
+    ], workers)
+    for function, result, error in listings:
+        if error is not None:
+            raise error
+    schedules, escalation_policies, teams, services = [
+        x[1] for x in listings
+    ]
+    logging.info('GOT schedules, escalation policies, teams and services')
+    details = run_parallel(
+        lambda x: delete_user.get_schedule(x['id']),
+        schedules,
+        workers
+    )
+    members = run_parallel(
+        lambda x: delete_user.list_users_on_team(x['id']),
+        teams,
+        workers
+    )
+    for item, result, error in details + members:
+        if error is not None:
+            raise error
+    logging.info('GOT schedule details and team members')
+    plan = build_cleanup_plan(
+        [x[1] for x in details],
+        escalation_policies,
+        teams,
+        dict((x[0]['id'], len(x[1])) for x in members),
+        services
+    )
+    plan['planned_at'] = datetime.utcnow().isoformat() + 'Z'
+    return plan
+
+def apply_cleanup(delete_user, plan, workers=8):
+    """Apply a cleanup plan from plan_cleanup
+
+    Escalation policies are updated or deleted first, so that no longer
+    reference the schedules deleted after them, and empty teams go last.
+    Each stage applies its actions concurrently, and the changed schedules,
+    escalation policies and teams are saved to the rollback bundle.
+    """
+
+    report = {'applied': [], 'failed': []}
+
+    def update_escalation_policy(action):
+        ep = delete_user.get_escalation_policy(action['id'])
+        delete_user.capture_pre_image('escalation_policy', ep)
+        for rule in ep['escalation_rules']:
+            rule['targets'] = [
+                x for x in rule['targets']
+                if x['id'] not in action['remove_targets']
+            ]
+        ep['escalation_rules'] = [
+            x for x in ep['escalation_rules'] if x['targets']
+        ]
+        delete_user.update_escalation_policy(ep['id'], ep)
+
+    def delete_escalation_policy(action):
+        delete_user.capture_pre_image(
+            'escalation_policy',
+            delete_user.get_escalation_policy(action['id'])
+        )
+        delete_user.delete_escalation_policy(action['id'])
+
+    def update_schedule(action):
+        schedule = delete_user.get_schedule(action['id'])
+        delete_user.capture_pre_image('schedule', schedule)
+        schedule['schedule_layers'] = [
+            x for x in schedule['schedule_layers']
+            if x['id'] not in action['remove_layers']
+        ][::-1]
+        schedule.pop('users', None)
+        delete_user.update_schedule(schedule['id'], schedule)
+
+    def delete_schedule(action):
+        delete_user.capture_pre_image(
+            'schedule',
+            delete_user.get_schedule(action['id'])
+        )
+        delete_user.delete_schedule(action['id'])
+
+    def delete_team(action):
+        delete_user.capture_pre_image(
+            'team',
+            delete_user.get_team(action['id'])
+        )
+        delete_user.delete_team(action['id'])
+
+    stages = (
+        ('update_escalation_policy', update_escalation_policy),
+        ('delete_escalation_policy', delete_escalation_policy),
+        ('update_schedule', update_schedule),
+        ('delete_schedule', delete_schedule),
+        ('delete_team', delete_team)
+    )
+    for name, apply_action in stages:
+        actions = [x for x in plan['actions'] if x['action'] == name]
+        for action, result, error in run_parallel(apply_action, actions,
+                                                  workers):
+            if error is None:
+                report['applied'].append(action)
+            else:
+                logging.error('Could not {action} {id}: {error}'.format(
+                    action=name,
+                    id=action['id'],
+                    error=error
+                ))
+                report['failed'].append(dict(action, error=str(error)))
+        logging.info('Applied {action} actions'.format(action=name))
+    return report
+
+class Pipeline():
+    """Stages connected by bounded queues, each stage running on its own
+    threads, so that later items are still being read while earlier ones
+    are written and no more than a few items wait between stages
+
+    An ordered pipeline hands the items to each stage in the order they
+    were fed, even after a stage with several workers.
+    """
+
+    def __init__(self, maxsize=16, ordered=False):
+        self.maxsize = maxsize
+        self.ordered = ordered
+        self.stages = []
+        self.stopped = False
+        # (stage index, item) of the items left unprocessed by stop()
+        self.dropped = []
+
+    def add_stage(self, function, workers=1):
+        """Add a stage calling function(item), which returns the item for the
+        next stage or None to drop it
+        """
+
+        self.stages.append((function, workers))
+        return self
+
+    def stop(self):
+        """Stop feeding items and let the stages drain without processing
+        what is still queued, e.g. from a stage that has run out of time
+        """
+
+        self.stopped = True
+
+    def run(self, items):
+        """Pass the items through every stage, raising the first error once
+        the stages have stopped
+        """
+
+        queues = [Queue.Queue(self.maxsize) for x in self.stages]
+        # Marks the end of the items on a queue
+        done = object()
+        remaining = [workers for function, workers in self.stages]
+        errors = []
+        lock = threading.Lock()
+        # Results of each stage held back until those of every earlier item
+        # are passed on, by the sequence number of the item
+        held = [{} for x in self.stages]
+        next_numbers = [0 for x in self.stages]
+        # Results passed on by each stage, which number the items of the next
+        passed = [0 for x in self.stages]
+        conditions = [threading.Condition() for x in self.stages]
+
+        def feed():
+            try:
+                for number, item in enumerate(items):
+                    if errors or self.stopped:
+                        break
+                    queues[0].put((number, item))
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+            queues[0].put(done)
+
+        def pass_on(i, number, result):
+            # Pass the result of stage i to the next stage. None passes
+            # nothing on, but still lets the items after it through
+            if not self.ordered:
+                if result is not None and i + 1 < len(queues):
+                    queues[i + 1].put((number, result))
+                return
+            with conditions[i]:
+                # Keep no more than maxsize results held back
+                while (number >= next_numbers[i] + self.maxsize and
+                       not errors and not self.stopped):
+                    conditions[i].wait()
+                held[i][number] = result
+                while next_numbers[i] in held[i]:
+                    result = held[i].pop(next_numbers[i])
+                    if result is not None and i + 1 < len(queues):
+                        queues[i + 1].put((passed[i], result))
+                        passed[i] += 1
+                    next_numbers[i] += 1
+                conditions[i].notify_all()
+
+        def work(i, function):
+            while True:
+                item = queues[i].get()
+                if item is done:
+                    # Let the other workers of this stage see the end too
+                    queues[i].put(done)
+                    with lock:
+                        remaining[i] -= 1
+                        last = remaining[i] == 0
+                    if last and i + 1 < len(queues):
+                        queues[i + 1].put(done)
+                    return
+                number, item = item
+                # After an error or a stop, keep draining so that no stage
+                # blocks
+                result = None
+                if errors:
+                    pass
+                elif self.stopped:
+                    with lock:
+                        self.dropped.append((i, item))
+                else:
+                    try:
+                        result = function(item)
+                    except Exception as e:
+                        with lock:
+                            errors.append(e)
+                pass_on(i, number, result)
+
+        threads = [threading.Thread(target=feed)]
+        for i, (function, workers) in enumerate(self.stages):
+            threads.extend(
+                threading.Thread(target=work, args=(i, function))
+                for x in range(workers)
+            )
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+class WorkQueue():
+    """Queue of deprovision changes ordered by how urgently they stop the
+    user being paged
+    """
+
+    # Changes to what pages the user right now
+    ON_CALL = 0
+    # Changes to anything else that could page the user
+    ROUTING = 1
+    # Changes that do not affect paging, such as team membership
+    COSMETIC = 2
+
+    def __init__(self):
+        self.heap = []
+        # Keeps changes of the same priority in the order they were queued
+        self.count = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def put(self, priority, kind, item):
+        """Queue a change of a kind of object"""
+
+        heapq.heappush(self.heap, (priority, self.count, kind, item))
+        self.count += 1
+
+    def drain(self):
+        """Yield (priority, kind, item) for every change, most urgent first"""
+
+        while self.heap:
+            priority, count, kind, item = heapq.heappop(self.heap)
+            yield priority, kind, item
+
+class Deadline():
+    """Time budget of a run, checked before starting more work so that a run
+    stops between changes rather than running past its window
+    """
+
+    def __init__(self, at):
+        # Seconds since the epoch by which the run has to have finished
+        self.at = at
+
+    def get_seconds_left(self):
+        """Get the seconds left until the deadline, negative once past it"""
+
+        return self.at - time.time()
+
+    def allows(self, seconds):
+        """Check if work estimated to take this many seconds ends in time"""
+
+        return time.time() + seconds <= self.at
+
+def parse_deadline(value, now=None):
+    """Convert a --deadline value, either a number of seconds from now or an
+    ISO 8601 timestamp, to seconds since the epoch
+    """
+
+    now = time.time() if now is None else now
+    try:
+        return now + float(value)
+    except ValueError:
+        return parse_timestamp(value)
+
+class ProgressReporter():
+    """Report the progress of each phase of a deprovision as events"""
+
+    def __init__(self, style=None, stream=None, pd_rest=None):
+        # 'json' writes one JSON event per line, 'terminal' keeps a single
+        # status line up to date and None only keeps track
+        self.style = style
+        self.stream = stream or sys.stderr
+        self.pd_rest = pd_rest
+        self.phases = {}
+        self.lock = threading.Lock()
+
+    def start(self, phase, total=None):
+        """Start a phase of total items, if the total is known"""
+
+        with self.lock:
+            self.phases[phase] = {
+                'started': time.time(),
+                'done': 0,
+                'total': total
+            }
+            self.emit(self.get_event('phase_start', phase))
+
+    def advance(self, phase, count=1):
+        """Count items of a phase as processed"""
+
+        with self.lock:
+            self.phases[phase]['done'] += count
+            self.emit(self.get_event('progress', phase))
+
+    def end(self, phase):
+        """End a phase"""
+
+        with self.lock:
+            self.emit(self.get_event('phase_end', phase))
+
+    def iterate(self, phase, items, total=None):
+        """Yield items as a phase, counting each once it has been handled"""
+
+        if total is None and hasattr(items, '__len__'):
+            total = len(items)
+        self.start(phase, total)
+        for item in items:
+            yield item
+            self.advance(phase)
+        self.end(phase)
+
+    def get_event(self, event, phase):
+        """Build an event with the throughput and ETA of a phase"""
+
+        state = self.phases[phase]
+        elapsed = time.time() - state['started']
+        rate = state['done'] / elapsed if elapsed > 0 else None
+        eta = None
+        if rate and state['total'] is not None:
+            eta = max(state['total'] - state['done'], 0) / rate
+        return {
+            'event': event,
+            'phase': phase,
+            'done': state['done'],
+            'total': state['total'],
+            'in_flight': self.pd_rest.in_flight if self.pd_rest else None,
+            'rate': rate,
+            'eta': eta,
+            'elapsed': elapsed,
+            'time': datetime.utcnow().isoformat() + 'Z'
+        }
+
+    def emit(self, event):
+        """Write an event in the chosen style"""
+
+        if self.style == 'json':
+            self.stream.write(json.dumps(event) + '\n')
+        elif self.style == 'terminal':
+            self.stream.write('\r\033[K' + render_progress(event))
+            if event['event'] == 'phase_end':
+                self.stream.write('\n')
+        else:
+            return
+        self.stream.flush()
+
+def render_progress(event):
+    """Render a progress event as one compact status line"""
+
+    line = '{phase}: {done}'.format(phase=event['phase'], done=event['done'])
+    if event['total'] is not None:
+        line += '/{total}'.format(total=event['total'])
+    if event['rate'] is not None:
+        line += ' {rate:.1f}/s'.format(rate=event['rate'])
+    if event['in_flight']:
+        line += ' {in_flight} in flight'.format(in_flight=event['in_flight'])
+    if event['event'] == 'phase_end':
+        line += ' done in {elapsed:.0f}s'.format(elapsed=event['elapsed'])
+    elif event['eta'] is not None:
+        minutes, seconds = divmod(int(math.ceil(event['eta'])), 60)
+        line += ' ETA {minutes}m{seconds:02d}s'.format(
+            minutes=minutes,
+            seconds=seconds
+        )
+    return line
+
+def input_yn(message):
+    """Prompt for a yes or no
+
+    Summary: Prompt a y/n question
+    Attributes:
+        @param (prompt): question requiring y/n answer from user
+    Returns: Boolean value of the user's answer
+    """
+    response = raw_input(message+" (y/n): ").strip().lower()
+    valid_responses = ('n', 'y')
+    if response and response[0] in valid_responses:
+        return bool(valid_responses.index(response))
+    else:
+        return input_yn(message)
+
+class DeleteUser():
+    """Class to handle all user deletion logic"""
+
+    def __init__(self, access_token, requests_per_second=None):
+        self.pd_rest = PagerDutyREST(access_token, requests_per_second)
+        self.service_index = None
+        # Escalation policies already fetched or written during this run
+        self.escalation_policies = {}
+        # Warm index of memberships kept by long-running processes
+        self.membership_index = None
+        # Held while reading or updating the index, which webhook events
+        # update from other threads
+        self.index_lock = threading.RLock()
+        # Pre-images of changed objects, for rolling back
+        self.rollback_bundle = None
+        # Incidents resolved through this instance, which drop out of the
+        # open incidents listing
+        self.resolved_incident_ids = set()
+
+    def get_user_id(self, email):
+        """Get PagerDuty user ID from user email"""
+
+        r = self.pd_rest.get('/users', {'query': email})
+        for user in r['users']:
+            if user['email'].lower() == email.lower():
+                return user['id']
+        raise ValueError(
+            'Could not find user with email {email}'.format(email=email)
+        )
+
+    def get_user_ids(self, emails, skip_missing=False):
+        """Get PagerDuty user IDs for several user emails
+
+        Small batches are looked up one email at a time. When that would take
+        more requests than listing every user, all emails are resolved from a
+        directory of the account's users instead. Emails not found are left
+        out if skip_missing is set.
+        """
+
+        if len(emails) > 1:
+            pages = int(math.ceil(self.count_users() / 100.0))
+            if len(emails) > pages:
+                directory = UserDirectory(self.list_users())
+                logging.info('GOT users')
+                return directory.get_user_ids(emails, skip_missing)
+        user_ids = {}
+        for email in emails:
+            try:
+                user_ids[email] = self.get_user_id(email)
+            except ValueError:
+                if not skip_missing:
+                    raise
+        return user_ids
+
+    def count_users(self):
+        """Count the users in the account without listing them"""
+
+        r = self.pd_rest.get_page('/users', {'limit': 1, 'total': 'true'})
+        return r['total']
+
+    def list_users(self):
+        """Outputs list of all users"""
+
+        r = self.pd_rest.get('/users')
+        return r['users']
+
+    def get_user(self, user_id):
+        """Get a single user"""
+
+        r = self.pd_rest.get('/users/{id}'.format(id=user_id))
+        return r['user']
+
+    def capture_pre_image(self, object_type, obj):
+        """Record the full state of an object before it is changed"""
+
+        if self.rollback_bundle is not None:
+            self.rollback_bundle.add(object_type, obj)
+
+    def get_open_incidents_filter(self, user_id):
+        """Get the query parameters matching open incidents for the user"""
+
+        return {
+            'statuses[]': ['triggered', 'acknowledged'],
+            'user_ids[]': user_id,
+            # 'date_range': 'all',
+            # 'urgencies[]': 'suppressed',
+            # 'with_suppressed': True,
+            # 'service_ids[]': 'INSERT_ID',
+        }
+
+    def list_open_incidents(self, user_id):
+        """Get any open incidents assigned to the user"""
+
+        payload = self.get_open_incidents_filter(user_id)
+        payload['total'] = True
+        r = self.pd_rest.get('/incidents', payload)
+        return r
+
+    def count_open_incidents(self, user_id):
+        """Count the open incidents assigned to the user without listing
+        them
+        """
+
+        payload = self.get_open_incidents_filter(user_id)
+        payload['total'] = 'true'
+        payload['limit'] = 1
+        r = self.pd_rest.get_page('/incidents', payload)
+        return r['total']
+
+    def iter_open_incidents(self, user_id):
+        """Get the open incidents assigned to the user one page at a time
+
+        Incidents resolved while iterating drop out of the listing, so the
+        offset only skips the incidents of each page that are still open.
+        """
+
+        payload = self.get_open_incidents_filter(user_id)
+        payload['limit'] = 100
+        payload['offset'] = 0
+        seen = set()
+        while True:
+            r = self.pd_rest.get_page('/incidents', payload)
+            if not r['incidents']:
+                return
+            for incident in r['incidents']:
+                if incident['id'] not in seen:
+                    seen.add(incident['id'])
+                    yield incident
+            if not r.get('more'):
+                return
+            payload['offset'] += len([
+                x for x in r['incidents']
+                if x['id'] not in self.resolved_incident_ids
+            ])
+
+    def resolve_incidents(self, incidents, from_email):
+        """Resolves all incidents"""
+
+        for incident in incidents:
+            logging.info('Resolving {id}'.format(id=incident))
+            try:
+                self.resolve_open_incident(incident, from_email)
+            except:
+                logging.error(
+                    'Could not resolve incident {id}'.format(id=incident)
+                )
+
+    def resolve_open_incident(self, incident_id, from_email):
+        """Resolves an incident"""
+
+        payload = {
+            'incident': {
+                'type': 'incident_reference',
+                'status': 'resolved'
+            }
+        }
+        r = self.pd_rest.put(
+            '/incidents/{id}'.format(id=incident_id),
+            payload,
+            from_email
+        )
+        self.resolved_incident_ids.add(incident_id)
+        return r
+
+    def count_schedules(self):
+        """Count the schedules in the account without listing them"""
+
+        r = self.pd_rest.get_page('/schedules', {'limit': 1, 'total': 'true'})
+        return r['total']
+
+    def iter_schedules(self):
+        """Yield every schedule in the account, one page at a time"""
+
+        for page in self.pd_rest.iter_pages('/schedules'):
+            for schedule in page:
+                yield schedule
+
+    def count_teams(self):
+        """Count the teams in the account without listing them"""
+
+        r = self.pd_rest.get_page('/teams', {'limit': 1, 'total': 'true'})
+        return r['total']
+
+    def iter_teams(self):
+        """Yield every team in the account, one page at a time"""
+
+        for page in self.pd_rest.iter_pages('/teams'):
+            for team in page:
+                yield team
+
+    def list_schedules(self):
+        """Outputs list of all schedules"""
+
+        r = self.pd_rest.get('/schedules')
+        return r['schedules']
+
+    def list_teams(self):
+        """Outputs list of all teams"""
+
+        r = self.pd_rest.get('/teams')
+        return r['teams']
+
+    def get_team(self, team_id):
+        """Get a single team"""
+
+        r = self.pd_rest.get('/teams/{id}'.format(id=team_id))
+        return r['team']
+
+    def iter_audit_records(self, since):
+        """Yield the audit records of changes to users, schedules, escalation
+        policies, teams and services since a time
+        """
+
+        payload = {
+            'since': since,
+            'limit': 100,
+            'root_resource_types[]': [
+                'users',
+                'schedules',
+                'escalation_policies',
+                'teams',
+                'services'
+            ]
+        }
+        while True:
+            r = self.pd_rest.get_page('/audit/records', payload)
+            for record in r['records']:
+                yield record
+            if not r.get('next_cursor'):
+                return
+            payload['cursor'] = r['next_cursor']
+
+    def list_services(self):
+        """Outputs list of all services"""
+
+        r = self.pd_rest.get('/services')
+        return r['services']
+
+    def get_service(self, service_id):
+        """Get a single service"""
+
+        r = self.pd_rest.get('/services/{id}'.format(id=service_id))
+        return r['service']
+
+    def get_service_index(self):
+        """Get the index of services by escalation policy, building it once"""
+
+        if self.service_index is None:
+            self.service_index = ServiceIndex(self.list_services())
+            logging.info('GOT services')
+        return self.service_index
+
+    def list_users_on_team(self, team_id):
+        """List all users on a particular team"""
+
+        r = self.pd_rest.get('/users', {'team_ids[]': team_id})
+        return r['users']
+
+    def list_escalation_policies(self):
+        """Outputs list of all escalation policies"""
+
+        r = self.pd_rest.get('/escalation_policies')
+        return r['escalation_policies']
+
+    def build_membership_index(self):
+        """Index the schedules, escalation policies and teams of every user
+        in the account
+        """
+
+        membership_index = MembershipIndex()
+        for sched in self.list_schedules():
+            membership_index.add_schedule(self.get_schedule(sched['id']))
+        logging.info('GOT schedules for membership index')
+        for ep in self.list_escalation_policies():
+            membership_index.add_escalation_policy(ep)
+        logging.info('GOT escalation policies for membership index')
+        for team in self.list_teams():
+            membership_index.add_team(team, self.list_users_on_team(team['id']))
+        logging.info('GOT teams for membership index')
+        return membership_index
+
+    def get_on_call_schedule_ids(self, user_id):
+        """Get the IDs of the schedules the user is on call for right now"""
+
+        r = self.pd_rest.get('/oncalls', {'user_ids[]': user_id})
+        return set(
+            x['schedule']['id'] for x in r['oncalls'] if x.get('schedule')
+        )
+
+    def get_escalation_policy_priority(self, user_id, escalation_policy):
+        """Get how soon to change an escalation policy, which is first when
+        the user is paged directly by its first rule
+        """
+
+        escalation_rules = escalation_policy['escalation_rules']
+        if escalation_rules and any(
+            x['id'] == user_id for x in escalation_rules[0]['targets']
+        ):
+            return WorkQueue.ON_CALL
+        return WorkQueue.ROUTING
+
+    def list_user_escalation_policies(self, user_id):
+        """List all escalation policies user is on"""
+
+        r = self.pd_rest.get(
+            '/escalation_policies',
+            {'user_ids[]': user_id}
+        )
+        return r['escalation_policies']
+
+    def get_schedule(self, schedule_id):
+        """Get a single schedule without its rendered entries"""
+
+        r = self.pd_rest.get('/schedules/{id}'.format(id=schedule_id))
+        return self.strip_rendered_schedule(r['schedule'])
+
+    def strip_rendered_schedule(self, schedule):
+        """Remove the rendered schedule entries, which are never read"""
+
+        schedule.pop('final_schedule', None)
+        schedule.pop('overrides_subschedule', None)
+        for layer in schedule.get('schedule_layers', []):
+            layer.pop('rendered_schedule_entries', None)
+            layer.pop('rendered_coverage_percentage', None)
+        return schedule
+
+    def get_escalation_policy(self, escalation_policy_id):
+        """Get a single escalation policy, using the copy from earlier in the
+        run if there is one
+        """
+
+        if escalation_policy_id not in self.escalation_policies:
+            r = self.pd_rest.get(
+                '/escalation_policies/{id}'.format(id=escalation_policy_id)
+            )
+            self.escalation_policies[escalation_policy_id] = (
+                r['escalation_policy']
+            )
+        return copy.deepcopy(self.escalation_policies[escalation_policy_id])
+
+    def check_schedule_for_user(self, user_id, schedule):
+        """Check if a schedule contains a particular user"""
+
+        for user in schedule['users']:
+            if user['id'] == user_id:
+                return True
+        return False
+
+    def check_team_for_user(self, user_id, team_users):
+        """Check the users on a team for the deletion user"""
+
+        for user in team_users:
+            if user['id'] == user_id:
+                return True
+        return False
+
+    def get_user_layer_index(self, user_id, schedule_layer):
+        """Get the index of a user on a schedule layer"""
+
+        for i, user in enumerate(schedule_layer['users']):
+            # TODO: Fix once endpoint is fixed
+            if user['user']['id'] == user_id:
+                return i
+        return None
+
+    def get_target_indices(self, id, escalation_rules):
+        """Get the escalation rule indices and target indices for the user or
+        schedule
+        """
+
+        output = []
+        for i, rule in enumerate(escalation_rules):
+            for j, target in enumerate(rule['targets']):
+                if target['id'] == id:
+                    output.append({'rule': i, 'target': j})
+        return output
+
+    def remove_user_from_layer(self, index, schedule_layer):
+        """Remove a user from a schedule layer"""
+
+        del schedule_layer['users'][index]
+        return schedule_layer
+
+    def remove_from_escalation_policy(self, indices, escalation_rules):
+        """Remove a user or schedule from an escalation policy"""
+
+        for index in indices:
+            del escalation_rules[index['rule']]['targets'][index['target']]
+        return escalation_rules
+
+    def remove_user_from_team(self, team_id, user_id):
+        """Remove a user from a team"""
+
+        r = self.pd_rest.delete(
+            '/teams/{team_id}/users/{user_id}'.format(
+                team_id=team_id,
+                user_id=user_id
+            )
+        )
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.remove_team_user(team_id, user_id)
+        return r
+
+    def delete_team(self, team_id):
+        """Deletes the team"""
+
+        r = self.pd_rest.delete('/teams/{id}'.format(id=team_id))
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.remove_team(team_id)
+        return r
+
+    def update_schedule(self, schedule_id, schedule):
+        """Updates the schedule"""
+
+        payload = {
+            'schedule': self.strip_rendered_schedule(schedule)
+        }
+        r = self.pd_rest.put(
+            '/schedules/{id}'.format(id=schedule_id),
+            payload
+        )
+        # The payload has its layers reversed and no users, so the index
+        # gets the schedule as it reads back
+        if self.membership_index is not None:
+            schedule = self.get_schedule(schedule_id)
+            with self.index_lock:
+                self.membership_index.add_schedule(schedule)
+        return r
+
+    def delete_schedule(self, schedule_id):
+        """Deletes the schedule"""
+
+        r = self.pd_rest.delete('/schedules/{id}'.format(id=schedule_id))
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.remove_schedule(schedule_id)
+        return r
+
+    def create_schedule(self, schedule):
+        """Creates the schedule"""
+
+        r = self.pd_rest.post(
+            '/schedules',
+            schedule
+        )
+        return r
+
+    def update_escalation_policy(self, escalation_policy_id, ep):
+        """Updates the escalation policy"""
+
+        # Delete description in case it is null
+        ep.pop('description', None)
+        payload = {
+            'escalation_policy': ep
+        }
+        r = self.pd_rest.put(
+            '/escalation_policies/{id}'.format(id=escalation_policy_id),
+            payload
+        )
+        self.escalation_policies[escalation_policy_id] = copy.deepcopy(ep)
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.add_escalation_policy(ep)
+        return r
+
+    def delete_escalation_policy(self, escalation_policy_id):
+        """Deletes the escalation policy"""
+
+        r = self.pd_rest.delete(
+            '/escalation_policies/{id}'.format(id=escalation_policy_id)
+        )
+        self.escalation_policies.pop(escalation_policy_id, None)
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.remove_escalation_policy(
+                    escalation_policy_id
+                )
+        return r
+
+    def create_escalation_policy(self, escalation_policy):
+        """Creates the escalation policy"""
+
+        payload = {
+            'escalation_policy': escalation_policy
+        }
+        r = self.pd_rest.post(
+            '/escalation_policies',
+            payload
+        )
+        return r
+
+    def cache_schedule(self, schedule, cache):
+        """Adds current schedule to the cache of affected schedules"""
+
+        cache.append({
+            'id': schedule['id'],
+            'name': schedule['name']
+        })
+        return cache
+
+    def cache_team(self, team, cache):
+        """Adds current team to the cache of affected teams"""
+
+        cache.append({
+            'id': team['id'],
+            'name': team['name']
+        })
+        return cache
+
+    def cache_escalation_policy(self, escalation_policy, cache):
+        """Adds current escalation policy to the cache of affected EPs"""
 
         cache.append({
             'id': escalation_policy['id'],
@@ -406,75 +2651,123 @@ class DeleteUser():
         })
         return cache
 
+    def cache_blocked_escalation_policy(self, escalation_policy, services,
+                                        cache):
+        """Adds an empty escalation policy that services still use to the
+        cache of escalation policies that could not be deleted
+        """
+
+        cache.append({
+            'id': escalation_policy['id'],
+            'name': escalation_policy['name'],
+            'services': services
+        })
+        return cache
+
     def delete_user(self, user_id):
         """Delete user from PagerDuty"""
 
         r = self.pd_rest.delete('/users/{id}'.format(id=user_id))
+        with self.index_lock:
+            if self.membership_index is not None:
+                self.membership_index.remove_user(user_id)
         return r == 204
 
+def init_logging():
+    """Log to a timestamped file in ./logs unless logging is already set up"""
+
+    if logging.getLogger().handlers:
+        return
+    if not os.path.isdir(os.path.join(os.getcwd(), './logs')):
+        os.mkdir(os.path.join(os.getcwd(), './logs'))
+    logging.basicConfig(filename='./logs/{timestamp}.log'.format(
+        timestamp=datetime.now().isoformat()
+    ), level=logging.INFO)
+
 def main(access_token, user_email, from_email, prompt_del=False,
-        prompt_res=False):
+        prompt_res=False, service_index=None, user_id=None, delete_user=None,
+        print_report=True, ask=None, rollback_bundle=None, progress=None,
+        workers=4, deadline=None, write_lock=None, memberships=None):
     """Handle command-line logic to delete user"""
 
-    if prompt_del and not input_yn("Proceed with user deletion?"):
+    # Answer y/n questions at the terminal unless told otherwise
+    ask = ask or input_yn
+    if prompt_del and not ask("Proceed with user deletion?"):
         return
 
 
     # Initialize logging
-    if not os.path.isdir(os.path.join(os.getcwd(), './logs')):
-        os.mkdir(os.path.join(os.getcwd(), './logs'))
-    logging.basicConfig(filename='./logs/{timestamp}.log'.format(
-        timestamp=datetime.now().isoformat()
-    ), level=logging.INFO)
+    init_logging()
     logging.info('Start of main logic')
+    started = time.time()
     # Declare cache variables
     schedule_cache = []
     escalation_policy_cache = []
     team_cache = []
-    # Declare an instance of the DeleteUser class
-    delete_user = DeleteUser(access_token)
-    # Get the user ID of the user to be deleted
-    user_id = delete_user.get_user_id(user_email)
+    blocked_escalation_policy_cache = []
+    # Declare an instance of the DeleteUser class unless a warm one is reused
+    if delete_user is None:
+        delete_user = DeleteUser(access_token)
+    # Reuse a services index built for an earlier user in the same batch
+    if service_index is not None:
+        delete_user.service_index = service_index
+    membership_index = delete_user.membership_index
+    # The index only finds the objects to change. Each one is read again
+    # before it is rewritten, so that edits made since are not overwritten
+    delete_user.escalation_policies = {}
+    # Report progress of listings and of each phase below
+    if progress is None:
+        progress = ProgressReporter()
+    else:
+        progress.pd_rest = delete_user.pd_rest
+        delete_user.pd_rest.progress = progress
+    # Get the user ID of the user to be deleted unless already resolved
+    if user_id is None:
+        user_id = delete_user.get_user_id(user_email)
     logging.info('User ID: {id}'.format(id=user_id))
+    # Keep the pre-image of every object changed below for rolling back
+    if rollback_bundle is None:
+        rollback_bundle = new_rollback_bundle(user_id)
+    delete_user.rollback_bundle = rollback_bundle
     # Check for open incidents user is currently in use for
-    incidents = delete_user.list_open_incidents(user_id)
-    if incidents['total'] > 0:
-        incident_output = ""
-        incident_ids = []
-        for incident in incidents['incidents']:
-            incident_output = "{current}\n[#{number}]: {description}".format(
-                current=incident_output,
-                number=incident['incident_number'],
-                description=incident['description'].encode('utf-8')
-            )
-            incident_ids.append(incident['id'])
-        response = not prompt_res or input_yn(
-            'There are currently {total} open incidents that this user is in '\
-            'use for:{incidents}\n'\
-            'Do you want to auto-resolve the {total} incidents above? (y/n): '
-            .format(
-                total=incidents['total'],
-                incidents=incident_output
-            )
-        )
-        if response:
-            logging.critical(
-                ('There are currently {total} open incidents that this user is'
-                 ' in use for. Please resolve the following incidents and '
-                 'try again:{incidents}'.format(
-                    total=incidents['total'],
-                    incidents=incident_output
-                    )
-                 )
+    total_incidents = delete_user.count_open_incidents(user_id)
+    if total_incidents > 0:
+        # Incidents listed to be printed are kept, without their bodies, so
+        # that they are not listed again to be resolved
+        incidents = None
+        if prompt_res and print_report:
+            print 'There are currently {total} open incidents that this user '\
+                'is in use for:'.format(total=total_incidents)
+            incidents = []
+            for incident in delete_user.iter_open_incidents(user_id):
+                print '[#{number}]: {description}'.format(
+                    number=incident['incident_number'],
+                    description=incident['description'].encode('utf-8')
+                )
+                incidents.append({
+                    'id': incident['id'],
+                    'incident_number': incident['incident_number'],
+                    'description': incident['description']
+                })
+        if incidents is None:
+            incidents = delete_user.iter_open_incidents(user_id)
+        response = not prompt_res or ask(
+            'Do you want to auto-resolve the {total} incidents above?'.format(
+                total=total_incidents
             )
+        )
+        if not response:
+            for incident in incidents:
+                logging.critical('Open incident [#{number}]: {description}'
+                    .format(
+                        number=incident['incident_number'],
+                        description=incident['description'].encode('utf-8')
+                    )
+                )
             raise Exception(
                 ('There are currently {total} open incidents that this user is'
-                 ' in use for. Please resolve the following incidents and '
-                 'try again:{incidents}'.format(
-                    total=incidents['total'],
-                    incidents=incident_output
-                    )
-                 )
+                 ' in use for. Please resolve the incidents listed in the log '
+                 'and try again.'.format(total=total_incidents))
             )
         else:
             if not from_email:
@@ -482,47 +2775,225 @@ def main(access_token, user_email, from_email, prompt_del=False,
                     "Please enter email address of the requesting agent: "
                 ).strip()
             logging.info('Resolving all open incidents...')
-            delete_user.resolve_incidents(incident_ids, from_email)
+            delete_user.resolve_incidents(
+                progress.iterate(
+                    'resolve incidents',
+                    (x['id'] for x in incidents),
+                    total_incidents
+                ),
+                from_email
+            )
             logging.info('Successfully resolved all open incidents')
-    # Get a list of all escalation policies
-    escalation_policies = delete_user.list_user_escalation_policies(user_id)
+    # Queue every change, so that those which stop pages reaching the user
+    # are made before the rest
+    work_queue = WorkQueue()
+    on_call_schedule_ids = delete_user.get_on_call_schedule_ids(user_id)
+    # Get a list of all escalation policies, or those found for a whole batch
+    # of users at once
+    if memberships is not None:
+        escalation_policies = memberships['escalation_policies']
+    elif membership_index is not None:
+        with delete_user.index_lock:
+            escalation_policies = (
+                membership_index.get_escalation_policies_for_user(user_id)
+            )
+    else:
+        escalation_policies = delete_user.list_user_escalation_policies(
+            user_id
+        )
     logging.info('GOT escalation policies')
-    logging.debug('EPs: \n{eps}'.format(eps=json.dumps(escalation_policies)))
-    for i, ep in enumerate(escalation_policies):
-        # Cache escalation policy
-        escalation_policy_cache = delete_user.cache_escalation_policy(
-            ep,
-            escalation_policy_cache
+    # Only serialize listings for the log when they will be written
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if debug:
+        logging.debug('EPs: \n{eps}'.format(
+            eps=json.dumps(escalation_policies)
+        ))
+    for ep in escalation_policies:
+        # Work on the latest copy, which removing a schedule may change first
+        if membership_index is None:
+            delete_user.escalation_policies.setdefault(
+                ep['id'],
+                copy.deepcopy(ep)
+            )
+        work_queue.put(
+            delete_user.get_escalation_policy_priority(user_id, ep),
+            'escalation_policy',
+            ep['id']
+        )
+    # Get the user's schedules and teams from the index. Without one, only
+    # the schedules the user is on call for are queued, and every other
+    # schedule and team is streamed from the account's listings after them
+    if memberships is not None:
+        schedules = memberships['schedules']
+    elif membership_index is not None:
+        with delete_user.index_lock:
+            schedules = membership_index.get_schedules_for_user(user_id)
+    if membership_index is not None:
+        if debug:
+            logging.debug('Schedules: \n%s', json.dumps(schedules))
+        for sched in schedules:
+            if sched['id'] in on_call_schedule_ids:
+                work_queue.put(WorkQueue.ON_CALL, 'schedule', sched)
+            else:
+                work_queue.put(WorkQueue.ROUTING, 'schedule', sched)
+        if memberships is not None:
+            teams = memberships['teams']
+        else:
+            with delete_user.index_lock:
+                teams = membership_index.get_teams_for_user(user_id)
+        logging.info('GOT teams')
+        if debug:
+            logging.debug('Teams: \n{teams}'.format(teams=json.dumps(teams)))
+        for team in teams:
+            work_queue.put(WorkQueue.COSMETIC, 'team', team)
+        total_changes = len(work_queue)
+    else:
+        for schedule_id in sorted(on_call_schedule_ids):
+            work_queue.put(WorkQueue.ON_CALL, 'schedule', {'id': schedule_id})
+        total_changes = (
+            len(work_queue) + delete_user.count_schedules() -
+            len(on_call_schedule_ids) + delete_user.count_teams()
         )
+
+    # Without time for every change before the deadline, team memberships are
+    # left for the user's deletion to remove, and the run stops before any
+    # change that would not be made in time, leaving the user in place
+    checkpoint = {'shed': [], 'stopped': False, 'pending': []}
+    write_seconds = []
+
+    def estimate_write_seconds():
+        # The slowest write so far, as deleting a schedule also rewrites its
+        # escalation policies
+        if write_seconds:
+            return max(write_seconds)
+        event = progress.get_event('progress', 'changes')
+        return event['elapsed'] / event['done'] if event['done'] else 0
+
+    def list_changes():
+        for change in work_queue.drain():
+            yield change
+        if membership_index is not None:
+            return
+        for sched in delete_user.iter_schedules():
+            if sched['id'] not in on_call_schedule_ids:
+                yield WorkQueue.ROUTING, 'schedule', sched
+        for team in delete_user.iter_teams():
+            yield WorkQueue.COSMETIC, 'team', team
+
+    def fetch_change(change):
+        priority, kind, item = change
+        user_included = True
+        if kind == 'team' and checkpoint['shed']:
+            return priority, kind, item, False
+        # Get the specific schedule, even if the index holds a copy
+        if kind == 'schedule':
+            item = delete_user.get_schedule(item['id'])
+        # Check if user is in schedule
+        if kind == 'schedule':
+            user_included = delete_user.check_schedule_for_user(user_id, item)
+        elif kind == 'team' and membership_index is None:
+            team_users = delete_user.list_users_on_team(item['id'])
+            user_included = delete_user.check_team_for_user(
+                user_id,
+                team_users
+            )
+        return priority, kind, item, user_included
+
+    def rewrite_change(change):
+        priority, kind, item, user_included = change
+        progress.advance('changes')
+        if deadline is not None and not checkpoint['shed']:
+            eta = progress.get_event('progress', 'changes')['eta']
+            if eta is not None and not deadline.allows(
+                    eta + 2 * estimate_write_seconds()):
+                logging.warning('Not enough time left before the deadline '
+                    'for every change. Leaving team memberships for the '
+                    'deletion of the user to remove')
+                checkpoint['shed'].append('team memberships')
+        if not user_included:
+            return None
+        # With a write lock, schedules are read again and rewritten while
+        # holding it
+        if kind == 'schedule' and write_lock is None:
+            rewrite_schedule(item)
+        return priority, kind, item
+
+    def write_change(change):
+        priority, kind, item = change
+        if deadline is not None and not deadline.allows(
+                estimate_write_seconds()):
+            if not checkpoint['stopped']:
+                logging.warning('Stopping before the deadline with changes '
+                    'left to make')
+                checkpoint['stopped'] = True
+                pipeline.stop()
+            checkpoint['pending'].append(change)
+            return
+        began = time.time()
+        if write_lock is None:
+            process[kind](item)
+        else:
+            # Runs sharing an account read and rewrite each object while
+            # holding its write lock, so none of them writes back a copy
+            # read before another run's write
+            with write_lock:
+                delete_user.escalation_policies.clear()
+                if kind == 'schedule':
+                    item = delete_user.get_schedule(item['id'])
+                    if not delete_user.check_schedule_for_user(user_id, item):
+                        return
+                    rewrite_schedule(item)
+                process[kind](item)
+        write_seconds.append(time.time() - began)
+        written_after[priority] = time.time() - started
+
+    def process_escalation_policy(escalation_policy_id):
+        ep = delete_user.get_escalation_policy(escalation_policy_id)
         ep_indices = delete_user.get_target_indices(
             user_id,
             ep['escalation_rules']
         )
-        escalation_policies[i]['escalation_rules'] = (
-            delete_user.remove_from_escalation_policy(
-                ep_indices,
-                ep['escalation_rules']
-            )
+        # The user may have been removed since the index was updated
+        if not ep_indices:
+            return
+        delete_user.capture_pre_image('escalation_policy', ep)
+        # Cache escalation policy
+        delete_user.cache_escalation_policy(ep, escalation_policy_cache)
+        ep['escalation_rules'] = delete_user.remove_from_escalation_policy(
+            ep_indices,
+            ep['escalation_rules']
         )
         # Remove rules with no more targets
-        escalation_policies[i]['escalation_rules'] = [
-            x for j, x in enumerate(escalation_policies[i]['escalation_rules'])
-            if not len(x['targets']) == 0
+        ep['escalation_rules'] = [
+            x for x in ep['escalation_rules'] if not len(x['targets']) == 0
         ]
+        # Services still using an empty EP would block its deletion
+        blocking_services = []
+        if len(ep['escalation_rules']) == 0:
+            blocking_services = (
+                delete_user.get_service_index().get_blocking_services(ep['id'])
+            )
         # Update the escalation policy. If it's empty, ask if the user wants to
         # delete the escalation policy
-        if len(escalation_policies[i]['escalation_rules']) != 0 or (
-            prompt_del and not input_yn(
+        if blocking_services:
+            logging.warning('Not deleting escalation policy %s. It no longer '
+                'has any on-call engineers or schedules but is still used by '
+                'services: %s', ep['name'],
+                ', '.join(x['name'] for x in blocking_services))
+            delete_user.cache_blocked_escalation_policy(
+                ep,
+                blocking_services,
+                blocked_escalation_policy_cache
+            )
+        elif len(ep['escalation_rules']) != 0 or (
+            prompt_del and not ask(
                 "Escalation policy (ID=%s, name=%s) will be empty. Delete it?"%(
-                    escalation_policies[i]['id'],
-                    escalation_policies[i]['name']
+                    ep['id'],
+                    ep['name']
                 )
             )):
             # Update the schedule.
-            delete_user.update_escalation_policy(
-                escalation_policies[i]['id'],
-                escalation_policies[i]
-            )
+            delete_user.update_escalation_policy(ep['id'], ep)
         # Attempt to delete the empty EP otherwise:
         else:
             try:
@@ -530,160 +3001,916 @@ def main(access_token, user_email, from_email, prompt_del=False,
             except Exception:
                 logging.warning('Could not delete escalation policy %s. It no '
                     'longer has any on-call engineers or schedules but may '
-                    'still be in use by services in your account.', 
-                    escalation_policies[i]['name'])
+                    'still be in use by services in your account.',
+                    ep['name'])
 
-    logging.info('Finished removing from escalation policies')
-    logging.debug('EP cache: \n%s', json.dumps(escalation_policy_cache))
-    # Get a list of all schedules
-    schedules = delete_user.list_schedules()
-    logging.debug('Schedules: \n%s', json.dumps(schedules))
+    def rewrite_schedule(schedule):
+        delete_user.capture_pre_image('schedule', schedule)
+        # Cache schedule
+        delete_user.cache_schedule(schedule, schedule_cache)
+        for i, layer in enumerate(schedule['schedule_layers']):
+            # Get index of user in layer
+            layer_index = delete_user.get_user_layer_index(user_id, layer)
+            # If this is the only user on the layer, end the layer now
+            if layer_index == 0 and len(layer['users']) == 1:
+                schedule['schedule_layers'][i]['end'] = (
+                    datetime.now().isoformat()
+                )
+            elif layer_index is not None:
+                schedule['schedule_layers'][i] = (
+                    delete_user.remove_user_from_layer(
+                        layer_index,
+                        layer
+                    )
+                )
+        schedule['schedule_layers'] = [
+            x for i, x in enumerate(schedule['schedule_layers'])
+            if not len(schedule['schedule_layers'][i]['users']) == 0
+        ]
+        # Reverse the schdule layers
+        schedule['schedule_layers'] = schedule['schedule_layers'][::-1]
+        del schedule['users']
 
-    for sched in schedules:
-        # Get the specific schedule
-        schedule = delete_user.get_schedule(sched['id'])
-        # Check if user is in schedule
-        if delete_user.check_schedule_for_user(user_id, schedule):
-            # Cache schedule
-            schedule_cache = delete_user.cache_schedule(
-                schedule,
-                schedule_cache
-            )
-            for i, layer in enumerate(schedule['schedule_layers']):
-                # Get index of user in layer
-                layer_index = delete_user.get_user_layer_index(user_id, layer)
-                # If this is the only user on the layer, end the layer now
-                if layer_index == 0 and len(layer['users']) == 1:
-                    schedule['schedule_layers'][i]['end'] = (
-                        datetime.now().isoformat()
+    def process_schedule(schedule):
+        # If deleting, remove the schedule from any escalation policies
+        if len(schedule['schedule_layers']) == 0 and (prompt_del and
+            ask(
+                ("Schedule (ID=%s, name=%s) will be empty after removing " \
+                 "user. Delete it?")%(schedule['id'], schedule['name'])
+            )):
+            for ep in schedule['escalation_policies']:
+                # Remove schedule from escalation policies...
+                escalation_policy = delete_user.get_escalation_policy(
+                    ep['id']
+                )
+                delete_user.capture_pre_image(
+                    'escalation_policy',
+                    escalation_policy
+                )
+                ep_indices = delete_user.get_target_indices(
+                    schedule['id'],
+                    escalation_policy['escalation_rules']
+                )
+                escalation_policy['escalation_rules'] = (
+                    delete_user.remove_from_escalation_policy(
+                        ep_indices,
+                        escalation_policy['escalation_rules']
                     )
-                elif layer_index is not None:
-                    schedule['schedule_layers'][i] = (
-                        delete_user.remove_user_from_layer(
-                            layer_index,
-                            layer
-                        )
+                )
+                # Remove rules with no targets
+                for i, rule in enumerate(
+                    escalation_policy['escalation_rules']
+                ):
+                    if len(rule['targets']) == 0:
+                        del escalation_policy['escalation_rules'][i]
+
+                blocking_services = []
+                if len(escalation_policy['escalation_rules']) == 0:
+                    blocking_services = (
+                        delete_user.get_service_index()
+                        .get_blocking_services(escalation_policy['id'])
                     )
-            schedule['schedule_layers'] = [
-                x for i, x in enumerate(schedule['schedule_layers'])
-                if not len(schedule['schedule_layers'][i]['users']) == 0
-            ]
-            # Reverse the schdule layers
-            schedule['schedule_layers'] = schedule['schedule_layers'][::-1]
-            del schedule['users']
-            # If deleting, remove the schedule from any escalation policies
-            if len(schedule['schedule_layers']) == 0 and (prompt_del and
-                input_yn(
-                    ("Schedule (ID=%s, name=%s) will be empty after removing " \
-                     "user. Delete it?")%(schedule['id'], schedule['name'])
-                )):
-                for ep in schedule['escalation_policies']:
-                    # Remove schedule from escalation policies...
-                    escalation_policy = delete_user.get_escalation_policy(
-                        ep['id']
+                # Update the escalation policy if there are rules or delete the escalation policy  # NOQA
+                if len(escalation_policy['escalation_rules']) > 0 :
+                    delete_user.update_escalation_policy(
+                        escalation_policy['id'],
+                        escalation_policy
                     )
-                    ep_indices = delete_user.get_target_indices(
-                        schedule['id'],
-                        escalation_policy['escalation_rules']
+                elif blocking_services:
+                    logging.warning('Not deleting escalation policy %s. '
+                        'It no longer has any on-call engineers or '
+                        'schedules but is still used by services: %s',
+                        escalation_policy['name'],
+                        ', '.join(x['name'] for x in blocking_services))
+                    delete_user.cache_blocked_escalation_policy(
+                        escalation_policy,
+                        blocking_services,
+                        blocked_escalation_policy_cache
                     )
-                    escalation_policy['escalation_rules'] = (
-                        delete_user.remove_from_escalation_policy(
-                            ep_indices,
-                            escalation_policy['escalation_rules']
+                elif not prompt_del or ask((
+                        "Escalation policy (ID=%s, name=%s) will be empty" \
+                        "after removing the schedule to be deleted. " \
+                        "Delete the escalation policy also?")%(
+                            escalation_policy['id'],
+                            escalation_policy['name']
                         )
-                    )
-                    # Remove rules with no targets
-                    for i, rule in enumerate(
-                        escalation_policy['escalation_rules']
                     ):
-                        if len(rule['targets']) == 0:
-                            del escalation_policy['escalation_rules'][i]
-
-                    # Update the escalation policy if there are rules or delete the escalation policy  # NOQA
-                    if len(escalation_policy['escalation_rules']) > 0 :
-                        delete_user.update_escalation_policy(
-                            escalation_policy['id'],
-                            escalation_policy
+                    try:
+                        delete_user.delete_escalation_policy(
+                            escalation_policy['id']
                         )
-                    elif not prompt_del or input_yn((
-                            "Escalation policy (ID=%s, name=%s) will be empty" \
-                            "after removing the schedule to be deleted. " \
-                            "Delete the escalation policy also?")%(
-                                escalation_policy['id'],
-                                escalation_policy['name']
-                            )
-                        ):
-                        try:
-                            delete_user.delete_escalation_policy(
-                                escalation_policy['id']
-                            )
-                        except Exception:
-                            logging.warning('The escalation policy {name} no \
-                            longer has any on-call engineers or schedules but \
-                            is still attached to services in your account.\
-                            '.format(name=escalation_policy['name']))
-                delete_user.delete_schedule(schedule['id'])
-            else: 
-                # Save updated schedule with user removed
-                delete_user.update_schedule(schedule['id'], schedule)
-
-    logging.info('Finished removing from schedules')
+                    except Exception:
+                        logging.warning('The escalation policy {name} no \
+                        longer has any on-call engineers or schedules but \
+                        is still attached to services in your account.\
+                        '.format(name=escalation_policy['name']))
+            delete_user.delete_schedule(schedule['id'])
+        else:
+            # Save updated schedule with user removed
+            delete_user.update_schedule(schedule['id'], schedule)
+
+    def process_team(team):
+        delete_user.capture_pre_image('team_membership', {
+            'id': '{team_id}/{user_id}'.format(
+                team_id=team['id'],
+                user_id=user_id
+            ),
+            'team_id': team['id'],
+            'user_id': user_id
+        })
+        # Cache team
+        delete_user.cache_team(team, team_cache)
+        delete_user.remove_user_from_team(team['id'], user_id)
+
+    process = {
+        'escalation_policy': process_escalation_policy,
+        'schedule': process_schedule,
+        'team': process_team
+    }
+    # Seconds from the start until the last change of each priority was
+    # written
+    written_after = {}
+    changes_started_after = time.time() - started
+    # Fetch the next schedules and teams while earlier changes are written.
+    # Changes are made one at a time in the order they were queued, however
+    # long each fetch takes
+    progress.start('changes', total_changes)
+    pipeline = Pipeline(ordered=True).add_stage(
+        fetch_change,
+        workers
+    ).add_stage(rewrite_change).add_stage(write_change)
+    pipeline.run(list_changes())
+    progress.end('changes')
+    # Changes left unwritten that are known to include the user: those that
+    # reached the write stage, and those stopped earlier, except schedules
+    # and teams from a sweep of the account that were never checked
+    known_dropped = 0
+    for stage, change in pipeline.dropped:
+        if stage == 2:
+            checkpoint['pending'].append(change)
+        elif stage == 1 and change[3] and change[1] != 'team':
+            checkpoint['pending'].append(change[:3])
+            known_dropped += 1
+        elif stage == 0 and (change[1] == 'escalation_policy' or (
+                change[1] == 'schedule' and (
+                    change[0] == WorkQueue.ON_CALL or
+                    membership_index is not None))):
+            checkpoint['pending'].append(change)
+            known_dropped += 1
+    checkpoint['pending'].sort(key=lambda x: x[0])
+    pending = [{
+        'type': kind,
+        'id': item if kind == 'escalation_policy' else item['id'],
+        'name': (
+            delete_user.escalation_policies.get(item, {}).get('name')
+            if kind == 'escalation_policy' else item.get('name')
+        )
+    } for priority, kind, item in checkpoint['pending']]
+    pending_ids = set(x['id'] for x in pending)
+    # Changes left unwritten through which the user can still be paged
+    pageable = [
+        x for x, y in zip(pending, checkpoint['pending'])
+        if y[0] in (WorkQueue.ON_CALL, WorkQueue.ROUTING)
+    ]
+    schedule_cache[:] = [
+        x for x in schedule_cache if x['id'] not in pending_ids
+    ]
+    unchecked = 0
+    if checkpoint['stopped']:
+        unchecked = max(
+            total_changes - progress.phases['changes']['done'] -
+            known_dropped,
+            0
+        )
+    # The user was off call once the urgent changes were written, and could
+    # no longer be paged once every escalation policy and schedule was. Until
+    # then, neither is known
+    off_call_after = written_after.get(WorkQueue.ON_CALL, changes_started_after)
+    unpageable_after = max([changes_started_after] + [
+        written_after[x] for x in (WorkQueue.ON_CALL, WorkQueue.ROUTING)
+        if x in written_after
+    ])
+    if [x for x in checkpoint['pending'] if x[0] == WorkQueue.ON_CALL]:
+        off_call_after = None
+    # Schedules left unchecked by a sweep may still include the user
+    if pageable or (unchecked and membership_index is None):
+        unpageable_after = None
+    logging.info('Finished removing from escalation policies, schedules and '
+        'teams')
+    if unpageable_after is None:
+        logging.warning('User may still be paged through {count} changes '
+            'left to make or {unchecked} objects left to check'.format(
+                count=len(pageable),
+                unchecked=unchecked
+            ))
+    else:
+        logging.info('User off call after {off_call:.1f}s and no longer '
+            'pageable after {unpageable:.1f}s'.format(
+                off_call=off_call_after,
+                unpageable=unpageable_after
+            ))
+    logging.debug('EP cache: \n%s', json.dumps(escalation_policy_cache))
     logging.debug('Schedule cache: {cache}'.format(cache=json.dumps(
         schedule_cache
     )))
-    # Get a list of all teams
-    teams = delete_user.list_teams()
-    logging.info('GOT teams')
-    logging.debug('Teams: \n{teams}'.format(teams=json.dumps(teams)))
-    for team in teams:
-        team_users = delete_user.list_users_on_team(team['id'])
-        if delete_user.check_team_for_user(user_id, team_users):
-            # Cache team
-            team_cache = delete_user.cache_team(team, team_cache)
-            delete_user.remove_user_from_team(team['id'], user_id)
-    logging.info('Finished removing from teams')
     logging.debug('Team cache: {cache}'.format(cache=json.dumps(team_cache)))
-    # Delete user
-    if delete_user.delete_user(user_id):
-        print 'User {email} has been Successfully removed!'.format(
-            email=user_email
-        )
+    # Delete user, once every change has been made in time
+    if deadline is not None and not checkpoint['stopped'] and (
+            not deadline.allows(2 * estimate_write_seconds())):
+        checkpoint['stopped'] = True
+    if checkpoint['stopped']:
+        logging.warning('Stopped at the deadline. Not deleting user {id} '
+            'until the {pending} changes left and {unchecked} objects left '
+            'to check are done'.format(
+                id=user_id,
+                pending=len(pending),
+                unchecked=unchecked
+            ))
+        deleted = False
     else:
-        print 'User {email} not removed; aborted, or API error.'.format(
-            email=user_email
-        )
-    print 'Schedules affected:\n{cache}'.format(cache=json.dumps(
-        schedule_cache
-    ))
+        if delete_user.rollback_bundle is not None:
+            delete_user.capture_pre_image(
+                'user',
+                delete_user.get_user(user_id)
+            )
+        deleted = delete_user.delete_user(user_id)
     logging.info('Schedules affected:\n{cache}'.format(cache=json.dumps(
         schedule_cache
     )))
-    print 'Escalation policies affected:\n{cache}'.format(cache=json.dumps(
-        escalation_policy_cache
-    ))
     logging.info('Escalation policies affected:\n{cache}'.format(
         cache=json.dumps(escalation_policy_cache)
     ))
-    print 'Teams affected:\n{cache}'.format(cache=json.dumps(team_cache))
+    if blocked_escalation_policy_cache:
+        logging.info('Empty escalation policies still used by services:\n'
+            '{cache}'.format(cache=json.dumps(blocked_escalation_policy_cache)))
     logging.info('Teams affected:\n{cache}'.format(cache=json.dumps(
         team_cache
     )))
-    
+    if print_report:
+        if deleted:
+            print 'User {email} has been Successfully removed!'.format(
+                email=user_email
+            )
+        elif checkpoint['stopped']:
+            print 'User {email} not removed; stopped at the deadline with '\
+                '{pending} changes left to make and {unchecked} objects left '\
+                'to check. Run again to finish.'.format(
+                    email=user_email,
+                    pending=len(pending),
+                    unchecked=unchecked
+                )
+            if pending:
+                print 'Changes left:\n{pending}'.format(
+                    pending=json.dumps(pending)
+                )
+        else:
+            print 'User {email} not removed; aborted, or API error.'.format(
+                email=user_email
+            )
+        print 'Schedules affected:\n{cache}'.format(cache=json.dumps(
+            schedule_cache
+        ))
+        print 'Escalation policies affected:\n{cache}'.format(
+            cache=json.dumps(escalation_policy_cache)
+        )
+        if blocked_escalation_policy_cache:
+            print 'Empty escalation policies still used by services:\n'\
+                '{cache}'.format(
+                    cache=json.dumps(blocked_escalation_policy_cache)
+                )
+        print 'Teams affected:\n{cache}'.format(cache=json.dumps(team_cache))
+        if checkpoint['shed']:
+            print 'Skipped to meet the deadline: {shed}'.format(
+                shed=', '.join(checkpoint['shed'])
+            )
+        if unpageable_after is None:
+            print 'User may still be paged through:\n{pageable}'.format(
+                pageable=json.dumps(pageable)
+            )
+            if unchecked and membership_index is None:
+                print 'or the {unchecked} objects left to check'.format(
+                    unchecked=unchecked
+                )
+        else:
+            print 'User could no longer be paged after {seconds:.1f}s'.format(
+                seconds=unpageable_after
+            )
+        if os.path.exists(rollback_bundle.filename):
+            print 'Rollback bundle: {filename}'.format(
+                filename=rollback_bundle.filename
+            )
+
     logging.info('End of main logic')
+    return {
+        'user_email': user_email,
+        'user_id': user_id,
+        'deleted': deleted,
+        'schedules': schedule_cache,
+        'escalation_policies': escalation_policy_cache,
+        'blocked_escalation_policies': blocked_escalation_policy_cache,
+        'teams': team_cache,
+        'off_call_after': off_call_after,
+        'unpageable_after': unpageable_after,
+        'rollback_bundle': rollback_bundle.filename,
+        'checkpoint': {
+            'stopped': checkpoint['stopped'],
+            'shed': checkpoint['shed'],
+            'pending': pending,
+            'pageable': pageable,
+            'unchecked': unchecked
+        }
+    }
+
+class OffboardingDaemon():
+    """Long-running process that deprovisions users from a local job queue
+
+    Connections, the membership index, the services index and the user
+    directory stay warm between jobs, so each job only pays for its writes.
+    """
+
+    def __init__(self, access_token, from_email=None):
+        self.access_token = access_token
+        self.from_email = from_email
+        init_logging()
+        logging.info('Warming up offboarding daemon')
+        self.delete_user = DeleteUser(access_token)
+        self.delete_user.membership_index = (
+            self.delete_user.build_membership_index()
+        )
+        self.delete_user.get_service_index()
+        self.user_directory = UserDirectory(self.delete_user.list_users())
+        # Jobs and index updates from webhooks only take turns on the index.
+        # Jobs read every object again before rewriting it
+        self.lock = self.delete_user.index_lock
+        self.updater = MembershipIndexUpdater(self.delete_user, self.lock)
+        logging.info('Offboarding daemon ready')
+
+    def start_webhooks(self, port, host='127.0.0.1', secret=None,
+                       reconcile_interval=None):
+        """Keep the index current from webhook change events received on a
+        local port, reconciling it with a full sweep every so often
+        """
+
+        server = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        server.updater = self.updater
+        server.secret = secret
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        logging.info('Receiving webhooks on {host}:{port}'.format(
+            host=host,
+            port=server.server_address[1]
+        ))
+        if reconcile_interval:
+            self.start_reconciling(reconcile_interval)
+        return server
+
+    def start_reconciling(self, interval):
+        """Reconcile the index with a full sweep every interval seconds"""
+
+        thread = threading.Thread(
+            target=self.updater.reconcile_forever,
+            args=(interval,)
+        )
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_user_id(self, email):
+        """Get a user ID from the warm directory, falling back to a query for
+        users created since it was built
+        """
+
+        try:
+            return self.user_directory.get_user_id(email)
+        except ValueError:
+            return self.delete_user.get_user_id(email)
+
+    def run_job(self, job):
+        """Run a single deprovision job and return its result"""
+
+        started = time.time()
+        result = {'job': job}
+        try:
+            from_email = job.get('from_email') or self.from_email
+            if not from_email:
+                raise ValueError('A from_email is required to run jobs')
+            result['report'] = main(
+                self.access_token,
+                job['user_email'],
+                from_email,
+                user_id=self.get_user_id(job['user_email']),
+                delete_user=self.delete_user,
+                print_report=False
+            )
+            result['status'] = 'done'
+        except Exception as e:
+            logging.exception('Job failed: {job}'.format(job=json.dumps(job)))
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = round(time.time() - started, 3)
+        return result
+
+    def run_stream(self, stream, output):
+        """Run jobs read as JSON lines from a stream, writing one JSON line
+        result per job
+        """
+
+        for line in iter(stream.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                result = self.run_job(json.loads(line))
+            except ValueError as e:
+                result = {'job': line, 'status': 'failed', 'error': str(e)}
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+
+    def run_spool(self, spool_dir, poll_interval=5):
+        """Run jobs dropped as JSON files into a spool directory
+
+        Each job file is claimed by renaming it, and its result is written to
+        the done or failed subdirectory under the same name.
+        """
+
+        for status in ('done', 'failed'):
+            if not os.path.isdir(os.path.join(spool_dir, status)):
+                os.mkdir(os.path.join(spool_dir, status))
+        while True:
+            names = sorted(
+                x for x in os.listdir(spool_dir) if x.endswith('.json')
+            )
+            for name in names:
+                path = os.path.join(spool_dir, name)
+                claimed = path + '.work'
+                try:
+                    os.rename(path, claimed)
+                except OSError:
+                    continue
+                try:
+                    with open(claimed) as job_file:
+                        result = self.run_job(json.load(job_file))
+                except ValueError as e:
+                    result = {'job': name, 'status': 'failed', 'error': str(e)}
+                with open(os.path.join(spool_dir, result['status'], name),
+                          'w') as result_file:
+                    json.dump(result, result_file)
+                os.remove(claimed)
+            if not names:
+                time.sleep(poll_interval)
+
+def deprovision_account(account, user_emails, from_email=None):
+    """Deprovision users from a single account without prompting
+
+    Summary: Run main() for each user found in the account
+    Attributes:
+        @param (account): dict with a name, access_token and optionally a
+            from_email and requests_per_second
+        @param (user_emails): emails of the users to deprovision
+        @param (from_email): requesting agent if the account sets none
+    Returns: dict with the account name, a result per user and timing
+    """
+
+    started = time.time()
+    result = {'account': account['name'], 'users': {}}
+    try:
+        # Without one, resolving incidents would prompt from several account
+        # threads at once
+        from_email = account.get('from_email') or from_email
+        if not from_email:
+            raise ValueError('A from_email is required for account {name}'
+                .format(name=account['name']))
+        delete_user = DeleteUser(
+            account['access_token'],
+            account.get('requests_per_second')
+        )
+        user_ids = delete_user.get_user_ids(user_emails, skip_missing=True)
+        for user_email in user_emails:
+            if user_email not in user_ids:
+                result['users'][user_email] = {'status': 'not_found'}
+        for user_email, user_id in sorted(user_ids.items()):
+            try:
+                report = main(
+                    account['access_token'],
+                    user_email,
+                    from_email,
+                    user_id=user_id,
+                    delete_user=delete_user,
+                    print_report=False
+                )
+                result['users'][user_email] = {
+                    'status': 'done',
+                    'report': report
+                }
+            except Exception as e:
+                logging.exception('Could not deprovision {email} in {account}'
+                    .format(email=user_email, account=account['name']))
+                result['users'][user_email] = {
+                    'status': 'failed',
+                    'error': str(e)
+                }
+        result['status'] = 'done'
+    except Exception as e:
+        logging.exception('Could not deprovision users in {account}'.format(
+            account=account['name']
+        ))
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    result['seconds'] = round(time.time() - started, 3)
+    return result
+
+def deprovision_accounts(accounts, user_emails, from_email=None):
+    """Deprovision users from several accounts in parallel
+
+    Each account runs in its own thread with its own connection pool and
+    rate limit, so the run takes as long as the slowest account.
+    """
+
+    init_logging()
+    started = time.time()
+    results = [None] * len(accounts)
+
+    def run(i):
+        results[i] = deprovision_account(accounts[i], user_emails, from_email)
+
+    threads = [
+        threading.Thread(target=run, args=(i,)) for i in range(len(accounts))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        'accounts': results,
+        'seconds': round(time.time() - started, 3)
+    }
+
+class DeprovisionJobs():
+    """Queue of deprovision jobs run on a bounded pool of worker threads
+
+    Jobs never prompt: empty escalation policies are deleted, schedules
+    left empty are updated with their last layers ended, and open incidents
+    are resolved unless a job sets resolve_incidents to false, in which case
+    it fails while the user still has open incidents. Jobs run at once take
+    turns writing to the account.
+    """
+
+    def __init__(self, access_token, from_email=None, workers=4):
+        self.access_token = access_token
+        self.from_email = from_email
+        self.jobs = {}
+        self.lock = threading.Lock()
+        # Held by a job while it reads and rewrites a shared object
+        self.write_lock = threading.Lock()
+        self.queue = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, request):
+        """Queue a deprovision job and return its status"""
+
+        if not isinstance(request, dict):
+            raise ValueError('A job must be a JSON object')
+        if not request.get('user_email'):
+            raise ValueError('A user_email is required')
+        if not (request.get('from_email') or self.from_email):
+            raise ValueError('A from_email is required')
+        job = {
+            'id': uuid.uuid4().hex,
+            'status': 'queued',
+            'request': request,
+            'submitted_at': datetime.now().isoformat()
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            status = copy.deepcopy(job)
+        self.queue.put(job['id'])
+        return status
+
+    def get_job(self, job_id):
+        """Get the status of a single job, or None if there is no such job"""
+
+        with self.lock:
+            return copy.deepcopy(self.jobs.get(job_id))
+
+    def list_jobs(self):
+        """Get the status of every job, oldest first"""
+
+        with self.lock:
+            return sorted(
+                [copy.deepcopy(x) for x in self.jobs.values()],
+                key=lambda x: x['submitted_at']
+            )
+
+    def update_job(self, job_id, **fields):
+        """Update the fields of a job"""
+
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def work(self):
+        """Run queued jobs forever"""
+
+        while True:
+            job_id = self.queue.get()
+            try:
+                self.run_job(job_id)
+            finally:
+                self.queue.task_done()
+
+    def run_job(self, job_id):
+        """Run a single queued job"""
+
+        request = self.get_job(job_id)['request']
+        started = time.time()
+        self.update_job(
+            job_id,
+            status='running',
+            started_at=datetime.now().isoformat()
+        )
+        try:
+            report = main(
+                self.access_token,
+                request['user_email'],
+                request.get('from_email') or self.from_email,
+                prompt_res=not request.get('resolve_incidents', True),
+                print_report=False,
+                ask=lambda message: False,
+                write_lock=self.write_lock
+            )
+            fields = {'status': 'done', 'report': report}
+        except Exception as e:
+            logging.exception('Job {id} failed'.format(id=job_id))
+            fields = {'status': 'failed', 'error': str(e)}
+        self.update_job(
+            job_id,
+            finished_at=datetime.now().isoformat(),
+            seconds=round(time.time() - started, 3),
+            **fields
+        )
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """HTTP server that handles each request in its own thread"""
+
+    daemon_threads = True
+
+class JobRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Handle requests to the deprovision job API
+
+    POST /jobs queues a job, GET /jobs lists jobs and GET /jobs/{id} gets
+    the status, report and timing of a single job.
+    """
+
+    def send_json(self, code, body):
+        """Send a JSON response"""
+
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        """Handle all GET requests"""
+
+        path = self.path.split('?')[0].rstrip('/')
+        if path == '/jobs':
+            return self.send_json(200, {'jobs': self.server.jobs.list_jobs()})
+        if path.startswith('/jobs/'):
+            job = self.server.jobs.get_job(path[len('/jobs/'):])
+            if job is not None:
+                return self.send_json(200, {'job': job})
+        self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        """Handle all POST requests"""
+
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            return self.send_json(404, {'error': 'Not found'})
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length))
+            job = self.server.jobs.submit(request)
+        except ValueError as e:
+            return self.send_json(400, {'error': str(e)})
+        self.send_json(202, {'job': job})
+
+    def log_message(self, format, *args):
+        logging.info('Job API: ' + format, *args)
+
+class MembershipIndexUpdater():
+    """Apply schedule, escalation policy, team, service and user change
+    events to the warm indexes of a DeleteUser as deltas
+
+    Events follow the v3 webhook shape, e.g. {"event_type":
+    "schedule.updated", "data": {"id": ..., ...}}. When the event data is
+    a full object it is applied as is, otherwise that one object is
+    fetched again. A periodic reconciliation sweep rebuilds the indexes in
+    case an event was missed.
+    """
+
+    def __init__(self, delete_user, lock=None):
+        self.delete_user = delete_user
+        self.lock = lock or threading.RLock()
+        # Events received while a reconciliation sweep is running
+        self.pending = None
+
+    def apply_event(self, event):
+        """Apply a single change event"""
+
+        with self.lock:
+            if self.pending is not None:
+                self.pending.append(event)
+        resource, _, action = event.get('event_type', '').partition('.')
+        data = event.get('data') or {}
+        if 'id' not in data:
+            return False
+        deleted = action == 'deleted'
+        if resource == 'schedule':
+            schedule = None
+            if not deleted:
+                if 'schedule_layers' in data:
+                    schedule = data
+                else:
+                    schedule = self.delete_user.get_schedule(data['id'])
+            with self.lock:
+                membership_index = self.delete_user.membership_index
+                if schedule is None:
+                    membership_index.remove_schedule(data['id'])
+                else:
+                    membership_index.add_schedule(schedule)
+        elif resource == 'escalation_policy':
+            escalation_policy = None
+            if not deleted:
+                if 'escalation_rules' in data:
+                    escalation_policy = data
+                else:
+                    r = self.delete_user.pd_rest.get(
+                        '/escalation_policies/{id}'.format(id=data['id'])
+                    )
+                    escalation_policy = r['escalation_policy']
+            with self.lock:
+                membership_index = self.delete_user.membership_index
+                self.delete_user.escalation_policies.pop(data['id'], None)
+                if escalation_policy is None:
+                    membership_index.remove_escalation_policy(data['id'])
+                else:
+                    membership_index.add_escalation_policy(escalation_policy)
+        elif resource == 'team':
+            team_users = None
+            if not deleted:
+                if 'users' in data:
+                    team_users = data['users']
+                else:
+                    team_users = self.delete_user.list_users_on_team(
+                        data['id']
+                    )
+            with self.lock:
+                membership_index = self.delete_user.membership_index
+                if team_users is None:
+                    membership_index.remove_team(data['id'])
+                else:
+                    membership_index.add_team({
+                        'id': data['id'],
+                        'name': data.get('name', data.get('summary'))
+                    }, team_users)
+        elif resource == 'service':
+            service = None
+            if not deleted:
+                if 'escalation_policy' in data:
+                    service = data
+                else:
+                    service = self.delete_user.get_service(data['id'])
+            with self.lock:
+                service_index = self.delete_user.service_index
+                if service_index is not None:
+                    service_index.remove_service(data['id'])
+                    if service is not None:
+                        service_index.add_services([service])
+        elif resource == 'user' and deleted:
+            with self.lock:
+                self.delete_user.membership_index.remove_user(data['id'])
+        else:
+            return False
+        logging.info('Applied {type} event for {id}'.format(
+            type=event['event_type'],
+            id=data['id']
+        ))
+        return True
+
+    def reconcile(self):
+        """Rebuild the indexes with a full sweep, then re-apply the events
+        received during the sweep
+        """
+
+        with self.lock:
+            self.pending = []
+        try:
+            membership_index = self.delete_user.build_membership_index()
+            service_index = ServiceIndex(self.delete_user.list_services())
+        except Exception:
+            with self.lock:
+                self.pending = None
+            raise
+        with self.lock:
+            self.delete_user.membership_index = membership_index
+            self.delete_user.service_index = service_index
+            self.delete_user.escalation_policies = {}
+            pending, self.pending = self.pending, None
+        for event in pending:
+            self.apply_event(event)
+        logging.info('Reconciled membership index')
+
+    def reconcile_forever(self, interval):
+        """Reconcile the indexes every interval seconds"""
+
+        while True:
+            time.sleep(interval)
+            try:
+                self.reconcile()
+            except Exception:
+                logging.exception('Could not reconcile membership index')
+
+class WebhookRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Receive v3 webhooks and apply their change events to the index"""
+
+    def send_json(self, code, body):
+        """Send a JSON response"""
+
+        data = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def verify_signature(self, body):
+        """Check the X-PagerDuty-Signature header against the shared secret"""
+
+        if not self.server.secret:
+            return True
+        expected = 'v1=' + hmac.new(
+            self.server.secret,
+            body,
+            hashlib.sha256
+        ).hexdigest()
+        signatures = self.headers.get('X-PagerDuty-Signature') or ''
+        return any(
+            hmac.compare_digest(expected, x.strip())
+            for x in signatures.split(',')
+        )
+
+    def do_POST(self):
+        """Handle all POST requests"""
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if not self.verify_signature(body):
+            return self.send_json(401, {'error': 'Invalid signature'})
+        try:
+            event = json.loads(body)['event']
+        except (KeyError, TypeError, ValueError):
+            return self.send_json(400, {'error': 'Expected a v3 webhook'})
+        try:
+            applied = self.server.updater.apply_event(event)
+        except Exception as e:
+            logging.exception('Could not apply webhook event')
+            return self.send_json(500, {'error': str(e)})
+        self.send_json(202, {'applied': applied})
+
+    def log_message(self, format, *args):
+        logging.info('Webhooks: ' + format, *args)
+
+def serve_jobs(access_token, from_email=None, port=8080, host='127.0.0.1',
+               workers=4):
+    """Serve the deprovision job API until interrupted"""
+
+    init_logging()
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+    server.jobs = DeprovisionJobs(access_token, from_email, workers)
+    logging.info('Serving job API on {host}:{port}'.format(
+        host=host,
+        port=server.server_address[1]
+    ))
+    server.serve_forever()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Delete a PagerDuty user')
     parser.add_argument(
         '--access-token', '-a',
         help='PagerDuty v2 access token',
-        dest='access_token',
-        required=True
+        dest='access_token'
     )
     parser.add_argument(
         '--user-email', '-u',
-        help='Email address of user to be deleted',
-        dest='user_email',
-        required=True
+        help='Email address of user to be deleted. Repeat to delete several '
+            'users.',
+        dest='user_emails', action='append'
     )
     parser.add_argument(
         '--from-email', '-f',
@@ -704,7 +3931,297 @@ if __name__ == '__main__':
             'empty objects automatically.',
         dest='prompt_del', action='store_false', default=True
     )
+    parser.add_argument(
+        '--connect-timeout',
+        help='Seconds to wait for a connection to the API.',
+        dest='connect_timeout', type=float,
+        default=PagerDutyREST.timeout[0]
+    )
+    parser.add_argument(
+        '--read-timeout',
+        help='Seconds to wait for the API to respond.',
+        dest='read_timeout', type=float, default=PagerDutyREST.timeout[1]
+    )
+    parser.add_argument(
+        '--hedge',
+        help='Send a duplicate of any GET request slower than the observed '
+            'p95 latency and use whichever response arrives first.',
+        dest='hedge', action='store_true'
+    )
+    parser.add_argument(
+        '--max-hedge-ratio',
+        help='Largest fraction of GET requests that may be hedged.',
+        dest='max_hedge_ratio', type=float,
+        default=PagerDutyREST.max_hedge_ratio
+    )
+    parser.add_argument(
+        '--record',
+        help='Record every API request and response, with the access token '
+            'scrubbed, to the cassette FILE.',
+        dest='record_file', metavar='FILE'
+    )
+    parser.add_argument(
+        '--replay',
+        help='Replay API responses from a cassette recorded with --record '
+            'instead of calling the API, e.g. to benchmark or regression '
+            'test a run offline. No access token is needed.',
+        dest='replay_file', metavar='FILE'
+    )
+    parser.add_argument(
+        '--replay-latency-scale',
+        help='Multiply the recorded latencies by this when replaying; 0 '
+            'replays without waiting.',
+        dest='latency_scale', type=float, default=1.0
+    )
+    parser.add_argument(
+        '--json-backend',
+        help='JSON library used for API payloads. By default the fastest '
+            'installed of ujson, simplejson and json is used.',
+        dest='json_backend', choices=JSONCodec.backends
+    )
+    parser.add_argument(
+        '--progress',
+        help='Report the progress, throughput and ETA of each phase to stderr '
+            'as a status line (terminal) or as one JSON event per line '
+            '(json).',
+        dest='progress', choices=['terminal', 'json']
+    )
+    parser.add_argument(
+        '--progress-file',
+        help='Write progress events to FILE instead of stderr.',
+        dest='progress_file', metavar='FILE'
+    )
+    parser.add_argument(
+        '--deadline',
+        help='Finish deprovisioning within SECONDS from now, or by an ISO '
+            '8601 time such as 2016-06-01T02:00:00Z. Team memberships are '
+            'left for the deletion of the user to remove when time runs '
+            'short, and a run that cannot finish stops between changes '
+            'without deleting the user and reports what is left.',
+        dest='deadline', metavar='SECONDS|TIME'
+    )
+    parser.add_argument(
+        '--accounts',
+        help='Deprovision the users from every account in a JSON config file '
+            'in parallel, e.g. {"accounts": [{"name": "...", "access_token": '
+            '"...", "from_email": "...", "requests_per_second": 10}]}. '
+            'Empty objects are deleted and incidents resolved without '
+            'prompting, and one merged JSON report is printed.',
+        dest='accounts_file', metavar='CONFIG'
+    )
+    parser.add_argument(
+        '--snapshot',
+        help='Save an indexed SQLite snapshot of the schedules, escalation '
+            'policies, teams, services and users in the account to FILE '
+            'instead of deleting a user. An existing snapshot is brought up '
+            'to date from the audit records of changes made since.',
+        dest='snapshot_file', metavar='FILE'
+    )
+    parser.add_argument(
+        '--from-snapshot',
+        help='Plan the deprovision from a snapshot saved with --snapshot '
+            'instead of sweeping the account. The snapshot is first brought '
+            'up to date from the audit records, and then updated with the '
+            'changes made.',
+        dest='from_snapshot', metavar='FILE'
+    )
+    parser.add_argument(
+        '--rollback',
+        help='Restore the objects changed by an earlier deprovision from the '
+            'rollback bundle it wrote to ./rollback, instead of deleting a '
+            'user. Needs --from-email to recreate a deleted user.',
+        dest='rollback_file', metavar='BUNDLE'
+    )
+    parser.add_argument(
+        '--sweep-orphans',
+        help='Scan the whole account for empty schedules, schedule layers '
+            'that have ended, escalation policies with no targets and teams '
+            'with no members, and save a plan to clean them up to PLAN '
+            'instead of deleting a user.',
+        dest='sweep_file', metavar='PLAN'
+    )
+    parser.add_argument(
+        '--apply-cleanup',
+        help='Apply a cleanup plan saved with --sweep-orphans.',
+        dest='cleanup_file', metavar='PLAN'
+    )
+    parser.add_argument(
+        '--daemon',
+        help='Run as a long-running daemon that keeps a warm index of the '
+            'account and deprovisions users from jobs such as '
+            '{"user_email": "...", "from_email": "..."}. Jobs are read as JSON '
+            'files dropped into SPOOL_DIR, or as JSON lines from stdin if '
+            'SPOOL_DIR is -.',
+        dest='spool_dir', metavar='SPOOL_DIR'
+    )
+    parser.add_argument(
+        '--serve',
+        help='Serve a local HTTP API on PORT for submitting deprovision jobs '
+            'and polling their status instead of deleting a user directly.',
+        dest='port', metavar='PORT', type=int
+    )
+    parser.add_argument(
+        '--workers',
+        help='Number of schedules and teams fetched at once while earlier '
+            'changes are written, of deprovision jobs the HTTP API runs at '
+            'once, or of requests made at once by --rollback, '
+            '--sweep-orphans and --apply-cleanup.',
+        dest='workers', type=int, default=4
+    )
+    parser.add_argument(
+        '--webhook-port',
+        help='In daemon mode, keep the index current from v3 webhooks '
+            'received on this local port.',
+        dest='webhook_port', type=int
+    )
+    parser.add_argument(
+        '--webhook-secret',
+        help='Secret used to verify the signature of received webhooks.',
+        dest='webhook_secret'
+    )
+    parser.add_argument(
+        '--reconcile-interval',
+        help='In daemon mode, seconds between full sweeps that reconcile the '
+            'index, with or without webhooks.',
+        dest='reconcile_interval', type=float, default=3600
+    )
+    parser.add_argument(
+        '--poll-interval',
+        help='Seconds to wait between checks of an empty spool directory.',
+        dest='poll_interval', type=float, default=5
+    )
 
     args = parser.parse_args()
-    main(args.access_token, args.user_email, args.from_email, 
-        prompt_del=args.prompt_del, prompt_res=args.prompt_res)
+    if args.replay_file:
+        PagerDutyREST.cassette = Cassette(args.replay_file, 'replay',
+            args.latency_scale)
+        args.access_token = args.access_token or 'replay'
+    elif args.record_file:
+        PagerDutyREST.cassette = Cassette(args.record_file, 'record')
+    if not args.access_token and not args.accounts_file:
+        parser.error('argument --access-token/-a is required')
+    PagerDutyREST.timeout = (args.connect_timeout, args.read_timeout)
+    PagerDutyREST.hedge = args.hedge
+    PagerDutyREST.max_hedge_ratio = args.max_hedge_ratio
+    if args.json_backend:
+        PagerDutyREST.codec = JSONCodec(args.json_backend)
+    progress = None
+    if args.progress:
+        progress = ProgressReporter(args.progress, args.progress_file and
+            open(args.progress_file, 'a'))
+    # Every user of a batch shares the one window
+    deadline = None
+    if args.deadline:
+        try:
+            deadline = Deadline(parse_deadline(args.deadline))
+        except ValueError:
+            parser.error('argument --deadline: expected a number of seconds '
+                'or an ISO 8601 time')
+    if args.port is not None:
+        serve_jobs(args.access_token, args.from_email, args.port,
+            workers=args.workers)
+    elif args.spool_dir:
+        daemon = OffboardingDaemon(args.access_token, args.from_email)
+        if args.webhook_port is not None:
+            daemon.start_webhooks(args.webhook_port,
+                secret=args.webhook_secret,
+                reconcile_interval=args.reconcile_interval)
+        elif args.reconcile_interval:
+            daemon.start_reconciling(args.reconcile_interval)
+        if args.spool_dir == '-':
+            daemon.run_stream(sys.stdin, sys.stdout)
+        else:
+            daemon.run_spool(args.spool_dir, args.poll_interval)
+    elif args.rollback_file:
+        if not args.from_email:
+            parser.error('argument --from-email/-f is required to roll back')
+        print json.dumps(
+            rollback(args.access_token, args.rollback_file, args.from_email,
+                args.workers),
+            indent=2
+        )
+    elif args.sweep_file:
+        init_logging()
+        plan = plan_cleanup(DeleteUser(args.access_token), args.workers)
+        with open(args.sweep_file, 'w') as sweep_file:
+            json.dump(plan, sweep_file, indent=2)
+        print '{actions} cleanup actions, {blocked} objects kept because '\
+            'they are still in use. Plan saved to {file}'.format(
+                actions=len(plan['actions']),
+                blocked=len(plan['blocked']),
+                file=args.sweep_file
+            )
+    elif args.cleanup_file:
+        init_logging()
+        with open(args.cleanup_file) as cleanup_file:
+            plan = json.load(cleanup_file)
+        delete_user = DeleteUser(args.access_token)
+        delete_user.rollback_bundle = new_rollback_bundle('cleanup')
+        report = apply_cleanup(delete_user, plan, args.workers)
+        report['rollback_bundle'] = delete_user.rollback_bundle.filename
+        print json.dumps(report, indent=2)
+    elif args.snapshot_file:
+        init_logging()
+        snapshot = AccountSnapshot(args.snapshot_file).refresh(
+            DeleteUser(args.access_token)
+        )
+        print 'Snapshot taken at {taken_at} and current as of {since} saved '\
+            'to {file}'.format(
+                taken_at=snapshot.get_taken_at(),
+                since=snapshot.get_meta('audit_since'),
+                file=args.snapshot_file
+            )
+    elif not args.user_emails:
+        parser.error('argument --user-email/-u is required')
+    elif args.accounts_file:
+        with open(args.accounts_file) as accounts_file:
+            accounts = json.load(accounts_file)['accounts']
+        if not args.from_email and [x for x in accounts
+                                    if not x.get('from_email')]:
+            parser.error('argument --from-email/-f is required unless every '
+                'account sets a from_email')
+        print json.dumps(
+            deprovision_accounts(accounts, args.user_emails, args.from_email),
+            indent=2
+        )
+    elif args.progress_file and not args.progress:
+        parser.error('argument --progress-file requires --progress')
+    elif args.from_snapshot:
+        snapshot = AccountSnapshot(args.from_snapshot)
+        if not snapshot.get_taken_at():
+            parser.error('{file} is not a snapshot taken with --snapshot'
+                .format(file=args.from_snapshot))
+        init_logging()
+        delete_user = DeleteUser(args.access_token)
+        snapshot.refresh(delete_user)
+        delete_user.membership_index = snapshot
+        delete_user.service_index = snapshot
+        for user_email in args.user_emails:
+            try:
+                user_id = snapshot.get_user_id(user_email)
+            except ValueError:
+                user_id = delete_user.get_user_id(user_email)
+            main(args.access_token, user_email, args.from_email,
+                prompt_del=args.prompt_del, prompt_res=args.prompt_res,
+                user_id=user_id, delete_user=delete_user, progress=progress,
+                workers=args.workers, deadline=deadline)
+    elif len(args.user_emails) == 1:
+        main(args.access_token, args.user_emails[0], args.from_email,
+            prompt_del=args.prompt_del, prompt_res=args.prompt_res,
+            progress=progress, workers=args.workers, deadline=deadline)
+    else:
+        # Resolve every user up front, sweep the account once for the whole
+        # batch and find the objects of every user in one pass over it
+        delete_user = DeleteUser(args.access_token)
+        user_ids = delete_user.get_user_ids(args.user_emails)
+        delete_user.get_service_index()
+        delete_user.membership_index = delete_user.build_membership_index()
+        memberships = delete_user.membership_index.get_for_users(
+            user_ids.values()
+        )
+        for user_email in args.user_emails:
+            main(args.access_token, user_email, args.from_email,
+                prompt_del=args.prompt_del, prompt_res=args.prompt_res,
+                user_id=user_ids[user_email], delete_user=delete_user,
+                progress=progress, workers=args.workers, deadline=deadline,
+                memberships=memberships[user_ids[user_email]])